@@ -0,0 +1,394 @@
+"""Benchmarks of the ULBMP codecs.
+
+usage: python bench.py [decode] [v4] [workers] [levels] [pixels] [codecs] [scale]
+                       [--json FILE] [--compare FILE] [--profile DIR] [--profiler {cprofile,pyinstrument}] [--repeat N]
+
+v1 / v2 decoding and the worker pool run on sample images tiled `scale` x `scale` times
+(default 4), v4 decoding and the v4 compression levels on the sample images as they are.
+
+`codecs` runs every encoder and decoder path (v1, v2, v3 at each depth with and without RLE,
+v4 at each level) on the sample images and on synthetic `256 * scale` square images, each case
+in a process of its own. It reports MB/s and pixels/s of raw RGB, compression ratio, peak of
+Python allocations and peak RSS. `--json` saves the results, `--compare` shows the change
+against results saved before (e.g. by another commit), `--profile` dumps a profile of the
+encode and the decode of each case.
+"""
+import argparse
+import cProfile
+import glob
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from encoding import Decoder1, Encoder
+from image import Image
+from pixel import Pixel
+
+class NaiveDecoder(Decoder1):
+	"""Per-pixel decode paths building one `Pixel` per pixel (reference implementation)."""
+	def read_pixels(self, bytes: bytes) -> list[Pixel]:
+		"""Pixels of the file, without the checks of `Decoder1.read_pixels` on a packed buffer."""
+		match self.version:
+			case 1:
+				return self.v1(bytes)
+			case 2:
+				return self.v2(bytes)
+			case 4:
+				return self.v4(bytes)
+			case _:
+				raise Exception(f'Unsupported version {self.version}')
+
+	def v1(self, bytes: bytes) -> list[Pixel]:
+		pixels = []
+
+		for i in range(self.header_len, len(bytes), 3):
+			pixels.append(Pixel(bytes[i], bytes[i+1], bytes[i+2]))
+
+		return pixels
+
+	def v2(self, bytes: bytes) -> list[Pixel]:
+		pixels = []
+
+		for i in range(self.header_len, len(bytes), 4):
+			for j in range(bytes[i]):
+				pixels.append(Pixel(bytes[i+1], bytes[i+2], bytes[i+3]))
+
+		return pixels
+
+	def v4(self, bytes: bytes) -> list[Pixel]:
+		pixels = []
+		oldPixel = Pixel(0, 0, 0)
+		i = self.header_len
+		while i < len(bytes):
+			byte = bytes[i]
+			if (byte == 0b11111111):
+				oldPixel = Pixel(bytes[i+1], bytes[i+2], bytes[i+3])
+				pixels.append(oldPixel)
+				i += 3
+			elif (byte & 0b11000000 == 0b00000000):
+				Dr = ((byte & 0b00110000) >> 4) -2
+				Dg = ((byte & 0b00001100) >> 2) -2
+				Db = ((byte & 0b00000011)) -2
+				oldPixel = Pixel(oldPixel.red + Dr, oldPixel.green + Dg, oldPixel.blue + Db)
+				pixels.append(oldPixel)
+			elif (byte & 0b11000000 == 0b01000000):
+				Dg = (byte & 0b00111111) - 32
+				Dr = ((bytes[i+1] & 0b11110000) >> 4) - 8 + Dg
+				Db = (bytes[i+1] & 0b00001111) - 8 + Dg
+				oldPixel = Pixel(oldPixel.red + Dr, oldPixel.green + Dg, oldPixel.blue + Db)
+				pixels.append(oldPixel)
+				i += 1
+			elif (byte & 0b10000000 == 0b10000000):
+				big_diff = (((byte & 0b00001111) << 4) | ((bytes[i+1] & 0b11110000) >> 4)) - 128
+				D1 = (((bytes[i+1] & 0b00001111) << 2) | ((bytes[i+2] & 0b11000000) >> 6)) - 32
+				D2 = ((bytes[i+2] & 0b00111111)) - 32
+				if (byte & 0b11110000 == 0b10100000):
+					Dr, Dg, Db = D1 + big_diff, D2 + big_diff, big_diff
+				elif (byte & 0b11110000 == 0b10010000):
+					Dr, Dg, Db = D1 + big_diff, big_diff, D2 + big_diff
+				else:
+					Dr, Dg, Db = big_diff, D1 + big_diff, D2 + big_diff
+				oldPixel = Pixel(oldPixel.red + Dr, oldPixel.green + Dg, oldPixel.blue + Db)
+				pixels.append(oldPixel)
+				i += 2
+			i += 1
+		return pixels
+
+class NaivePixel:
+	"""Pixel with a `__dict__`, checked and hashed through tuples (reference implementation)."""
+	def __init__(self, red: int, green: int, blue: int):
+		if (red < 0 or red > 255 or green < 0 or green > 255 or blue < 0 or blue > 255):
+			raise Exception('Invalid color value')
+
+		self._red = red
+		self._green = green
+		self._blue = blue
+
+	def __eq__(self, other: 'NaivePixel'):
+		if isinstance(other, NaivePixel):
+			return self._red == other._red and self._green == other._green and self._blue == other._blue
+		return False
+
+	def __hash__(self):
+		return hash((self._red, self._green, self._blue))
+
+def scale_up(img: Image, scale: int) -> Image:
+	"""Tile an image `scale` times horizontally and vertically."""
+	row_len = img.width * 3
+	data = bytearray()
+
+	for _ in range(scale):
+		for y in range(img.height):
+			data += img.data[y * row_len:(y + 1) * row_len] * scale
+	return Image(img.width * scale, img.height * scale, data)
+
+def timeit(func, *args) -> float:
+	"""Best time of a few runs of `func(*args)`, in seconds."""
+	best = float('inf')
+
+	for _ in range(3):
+		start = time.perf_counter()
+		func(*args)
+		best = min(best, time.perf_counter() - start)
+	return best
+
+def bench_decode(path: str, old: Decoder1, new: Decoder1) -> tuple[float, float]:
+	"""Time `read_pixels` of the old and the new decoder on the file at `path`."""
+	with open(path, 'rb') as file:
+		bytes = file.read()
+	old.read_header(bytes)
+	new.read_header(bytes)
+	return timeit(old.read_pixels, bytes), timeit(new.read_pixels, bytes)
+
+def report(name: str, size: int, old: float, new: float) -> None:
+	print(f"{name:<28} {size / 1e6:>8.2f} MB {old * 1e3:>10.1f} ms {new * 1e3:>9.2f} ms {old / new:>8.1f}x")
+
+def bench_v1_v2(scale: int) -> None:
+	print(f"{'decode':<28} {'size':>11} {'old':>13} {'new':>12} {'speedup':>9}")
+	with tempfile.TemporaryDirectory() as tmp:
+		for name in ('imgs/jelly_beans1.ulbmp', 'imgs/house2.ulbmp'):
+			img = scale_up(Decoder1().load_from(name), scale)
+
+			for version in (1, 2):
+				path = os.path.join(tmp, f'v{version}.ulbmp')
+				Encoder(img, version).save_to(path)
+				old, new = bench_decode(path, NaiveDecoder(), Decoder1())
+				report(f"{os.path.basename(name)} v{version}", os.path.getsize(path), old, new)
+
+def bench_v4(scale: int) -> None:
+	print(f"{'decode v4':<28} {'size':>11} {'old':>13} {'new':>12} {'speedup':>9}")
+	for name in sorted(glob.glob('imgs/*4.ulbmp')):
+		old, new = bench_decode(name, NaiveDecoder(), Decoder1())
+		report(os.path.basename(name), os.path.getsize(name), old, new)
+
+def bench_workers(scale: int) -> None:
+	"""Encode / decode time of v1 and v3 (depth 8) with 1, 2, 4 and 8 worker processes."""
+	img = scale_up(Decoder1().load_from('imgs/jelly_beans1.ulbmp'), scale)
+	# 3 bits of red and green, 2 bits of blue: at most 256 colors for v3
+	img.data[0::3] = img.data[0::3].translate(bytes(i & 0b11100000 for i in range(256)))
+	img.data[1::3] = img.data[1::3].translate(bytes(i & 0b11100000 for i in range(256)))
+	img.data[2::3] = img.data[2::3].translate(bytes(i & 0b11000000 for i in range(256)))
+
+	print(f"{'workers':<28} {'pixels':>11} {'workers':>8} {'encode':>12} {'decode':>12}")
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, 'bands.ulbmp')
+		for version, kwargs in ((1, {}), (3, {'depth': 8})):
+			encoder = Encoder(img, version, **kwargs)
+			for workers in (1, 2, 4, 8):
+				encode = timeit(encoder.save_to, path, workers)
+				decode = timeit(Decoder1().load_from, path, workers)
+				print(f"{f'v{version} {kwargs}':<28} {img.width * img.height / 1e6:>9.2f} M {workers:>8} {encode * 1e3:>9.1f} ms {decode * 1e3:>9.1f} ms")
+
+def bench_levels(scale: int) -> None:
+	"""Size, encode and decode time of v4 at each compression level, on every `imgs/*1.ulbmp`."""
+	print(f"{'v4 level':<28} {'level':>5} {'size':>11} {'ratio':>7} {'encode':>12} {'decode':>12}")
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, 'level.ulbmp')
+		for name in sorted(glob.glob('imgs/*1.ulbmp')):
+			img = Decoder1().load_from(name)
+			for level in (0, 1, 2):
+				encode = timeit(Encoder(img, 4, level=level).save_to, path)
+				decode = timeit(Decoder1().load_from, path)
+				size = os.path.getsize(path)
+				print(f"{os.path.basename(name):<28} {level:>5} {size / 1e3:>8.1f} kB {size / len(img.data):>7.3f} {encode * 1e3:>9.1f} ms {decode * 1e3:>9.1f} ms")
+
+def allocations(func, *args) -> tuple[float, int, object]:
+	"""Time and peak of memory allocated by `func(*args)`, and its result."""
+	tracemalloc.start()
+	start = time.perf_counter()
+	result = func(*args)
+	elapsed = time.perf_counter() - start
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return elapsed, peak, result
+
+def bench_pixels(scale: int) -> None:
+	"""Pixel objects of a whole image, and a set of them, with the old and the new `Pixel`."""
+	print(f"{'pixels':<28} {'pixels':>11} {'time':>12} {'peak':>11} {'bytes/px':>9} {'objects':>9}")
+	for name in ('imgs/jelly_beans1.ulbmp', 'imgs/lines1.ulbmp'):
+		img = scale_up(Decoder1().load_from(name), scale)
+		data = img.data
+		channels = (data[0::3], data[1::3], data[2::3])
+		count = img.width * img.height
+
+		for label, make in (('old Pixel()', NaivePixel), ('Pixel()', Pixel), ('Pixel.from_rgb()', Pixel.from_rgb)):
+			# timed without tracemalloc, from no shared pixels
+			elapsed = timeit(lambda: (Pixel._shared.clear(), list(map(make, *channels))))
+			_, peak, pixels = allocations(lambda: (Pixel._shared.clear(), list(map(make, *channels)))[1])
+			objects = len(set(map(id, pixels)))
+			print(f"{os.path.basename(name) + ' ' + label:<28} {count / 1e6:>9.2f} M {elapsed * 1e3:>9.1f} ms {peak / 1e6:>8.1f} MB {peak / count:>9.1f} {objects:>9}")
+			elapsed = timeit(set, pixels)
+			print(f"{'  set of them':<28} {'':>11} {elapsed * 1e3:>9.1f} ms")
+			del pixels
+
+def synthetic(kind: str, side: int) -> Image:
+	"""Square test image: `noise`, `gradient`, `flat` or `palette` (runs of 16 colors)."""
+	rand = random.Random(side)
+	size = side * side * 3
+
+	if (kind == 'noise'):
+		data = rand.randbytes(size)
+	elif (kind == 'gradient'):
+		ramp = bytes(x * 256 // side for x in range(side))
+		data = bytearray(size)
+		for y in range(side):
+			row = bytearray(side * 3)
+			row[0::3] = ramp
+			row[1::3] = bytes([y * 256 // side]) * side
+			row[2::3] = ramp[::-1]
+			data[y * side * 3:(y + 1) * side * 3] = row
+	elif (kind == 'flat'):
+		data = bytes((40, 120, 200)) * (side * side)
+	else:
+		colors = [rand.randbytes(3) for _ in range(16)]
+		data = bytearray()
+		while (len(data) < size):
+			data += rand.choice(colors) * rand.randint(1, 64)
+		data = data[:size]
+	return Image(side, side, data)
+
+def formats(img: Image) -> list[tuple[str, int, dict]]:
+	"""(label, version, keyword arguments) of every way to encode the image."""
+	colors = len(img.stats.colors(256))
+	cases = [('v1', 1, {}), ('v2', 2, {})]
+
+	for depth in (1, 2, 4, 8):
+		if (colors <= 1 << depth):
+			cases.append((f'v3 d{depth}', 3, {'depth': depth}))
+	if (colors <= 256):
+		cases.append(('v3 d8 rle', 3, {'depth': 8, 'rle': True}))
+	cases += [('v3 d24', 3, {'depth': 24}), ('v3 d24 rle', 3, {'depth': 24, 'rle': True})]
+	cases += [(f'v4 l{level}', 4, {'level': level}) for level in (0, 1, 2)]
+	return cases
+
+def encode(img: Image, version: int, kwargs: dict) -> bytes:
+	"""The image encoded in memory, through `Encoder.v1` to `v4`."""
+	encoder = Encoder(img, version, **kwargs)
+	file = io.BytesIO()
+	file.write(encoder.header(img.width, img.height))
+	encoder.encode(file, img.data)
+	encoder.finish(file)
+	return file.getvalue()
+
+def decode(payload: bytes) -> bytearray:
+	"""Pixels of an encoded image, through `Decoder1.v1` to `v4`."""
+	decoder = Decoder1()
+	decoder.read_header(payload)
+	return decoder.read_pixels(payload)
+
+def profile(func, path: str, profiler: str) -> None:
+	"""Write a profile of `func()` to `path` (.prof for cProfile, .html for pyinstrument)."""
+	if (profiler == 'pyinstrument'):
+		from pyinstrument import Profiler
+		prof = Profiler()
+		prof.start()
+		func()
+		prof.stop()
+		with open(path + '.html', 'w') as file:
+			file.write(prof.output_html())
+	else:
+		prof = cProfile.Profile()
+		prof.runcall(func)
+		prof.dump_stats(path + '.prof')
+
+def run_case(name: str, img: Image, label: str, version: int, kwargs: dict, repeat: int, profile_dir: str, profiler: str) -> dict:
+	"""Measures of one image in one format (run in a process of its own for its peak RSS)."""
+	payload = encode(img, version, kwargs)
+	if (decode(payload) != img.data):
+		raise Exception(f'{name} {label}: decoded pixels differ')
+
+	encode_time = min(timeit_once(encode, img, version, kwargs) for _ in range(repeat))
+	decode_time = min(timeit_once(decode, payload) for _ in range(repeat))
+	_, encode_peak, _ = allocations(encode, img, version, kwargs)
+	_, decode_peak, _ = allocations(decode, payload)
+
+	if (profile_dir):
+		case = f"{name}-{label}".replace(' ', '_')
+		profile(partial(encode, img, version, kwargs), os.path.join(profile_dir, case + '-encode'), profiler)
+		profile(partial(decode, payload), os.path.join(profile_dir, case + '-decode'), profiler)
+
+	raw = len(img.data)
+	pixels = img.width * img.height
+	return {'image': name, 'format': label, 'pixels': pixels, 'size': len(payload), 'ratio': len(payload) / raw,
+		'encode_s': encode_time, 'decode_s': decode_time,
+		'encode_MBps': raw / encode_time / 1e6, 'decode_MBps': raw / decode_time / 1e6,
+		'encode_pixels_per_s': pixels / encode_time, 'decode_pixels_per_s': pixels / decode_time,
+		'encode_alloc_peak': encode_peak, 'decode_alloc_peak': decode_peak,
+		'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+def timeit_once(func, *args) -> float:
+	start = time.perf_counter()
+	func(*args)
+	return time.perf_counter() - start
+
+def bench_codecs(scale: int, json_path: str=None, compare: str=None, profile_dir: str=None, profiler: str='cprofile', repeat: int=3) -> None:
+	"""Every encode and decode path on the sample images and synthetic ones, see the module docstring."""
+	images = [(os.path.basename(name).split('1.')[0], Decoder1().load_from(name)) for name in sorted(glob.glob('imgs/*1.ulbmp'))]
+	images += [(kind, synthetic(kind, 256 * scale)) for kind in ('noise', 'gradient', 'flat', 'palette')]
+	old = {}
+	if (compare):
+		with open(compare) as file:
+			old = {(case['image'], case['format']): case for case in json.load(file)['cases']}
+	if (profile_dir):
+		os.makedirs(profile_dir, exist_ok=True)
+
+	print(f"{'codecs':<24} {'ratio':>7} {'encode':>10} {'decode':>10} {'enc Mpx/s':>10} {'alloc enc':>10} {'alloc dec':>10} {'RSS':>8}{'  vs old enc / dec' if (old) else ''}")
+	results = []
+	# one process per case, its peak RSS is the case's own
+	with ProcessPoolExecutor(1, max_tasks_per_child=1) as pool:
+		for name, img in images:
+			for label, version, kwargs in formats(img):
+				case = pool.submit(run_case, name, img, label, version, kwargs, repeat, profile_dir, profiler).result()
+				results.append(case)
+				line = (f"{name + ' ' + label:<24} {case['ratio']:>7.3f} {case['encode_MBps']:>5.1f} MB/s {case['decode_MBps']:>5.1f} MB/s "
+					f"{case['encode_pixels_per_s'] / 1e6:>10.2f} {case['encode_alloc_peak'] / 1e6:>7.1f} MB {case['decode_alloc_peak'] / 1e6:>7.1f} MB "
+					f"{case['peak_rss'] / 1e6:>5.0f} MB")
+				if ((name, label) in old):
+					before = old[(name, label)]
+					line += f"  {case['encode_MBps'] / before['encode_MBps']:>5.2f}x / {case['decode_MBps'] / before['decode_MBps']:>5.2f}x"
+				print(line)
+
+	if (json_path):
+		try:
+			commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+		except OSError:
+			commit = ''
+		with open(json_path, 'w') as file:
+			json.dump({'commit': commit, 'python': sys.version, 'scale': scale, 'repeat': repeat, 'cases': results}, file, indent=1)
+
+SECTIONS = {'decode': bench_v1_v2, 'v4': bench_v4, 'workers': bench_workers, 'levels': bench_levels, 'pixels': bench_pixels, 'codecs': bench_codecs}
+
+def main(*args: str) -> None:
+	"""Run the sections named in `args` (all but `codecs` by default), a number in `args` is the scale."""
+	parser = argparse.ArgumentParser(prog='bench', description='Benchmarks of the ULBMP codecs.')
+	parser.add_argument('sections', nargs='*', help=f"sections to run, among {', '.join(SECTIONS)}, and the scale")
+	parser.add_argument('--json', help='write the results of `codecs` to this file')
+	parser.add_argument('--compare', help='results of `codecs` written before by --json, to compare with')
+	parser.add_argument('--profile', help='directory of a profile of each `codecs` case')
+	parser.add_argument('--profiler', default='cprofile', choices=('cprofile', 'pyinstrument'))
+	parser.add_argument('--repeat', type=int, default=3, help='runs of each `codecs` case, the best is kept')
+	options = parser.parse_args(args)
+
+	scale = next((int(arg) for arg in options.sections if arg.isdigit()), 4)
+	sections = [arg for arg in options.sections if not arg.isdigit()] or [name for name in SECTIONS if name != 'codecs']
+	if (options.json or options.compare or options.profile) and 'codecs' not in sections:
+		sections.append('codecs')
+
+	for name in sections:
+		if (name == 'codecs'):
+			bench_codecs(scale, options.json, options.compare, options.profile, options.profiler, max(options.repeat, 1))
+		else:
+			SECTIONS[name](scale)
+		print()
+
+if __name__ == "__main__":
+	main(*sys.argv[1:])
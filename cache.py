@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from encoding import Decoder
+from image import Image
+
+class ImageCache:
+	"""Decoded images kept by file, least recently used first out.
+
+	A file is known by its absolute path, modification time and size: a file written again
+	is decoded again. The packed RGB of up to `max_bytes` of images is kept in memory, with
+	`directory` the images pushed out of memory are kept on disk as raw RGB (up to `disk_bytes`),
+	listed in `index.json`. Each call returns a new `Image`, the cached pixels cannot be changed.
+	"""
+	def __init__(self, max_bytes: int=256 << 20, directory: str=None, disk_bytes: int=4 << 30):
+		self.max_bytes = max_bytes
+		self.directory = directory
+		self.disk_bytes = disk_bytes
+		self.lock = threading.Lock()
+		self.memory = OrderedDict() # key -> (width, height, data)
+		self.size = 0 # bytes in memory
+		self.disk = OrderedDict() # key -> (width, height, file name)
+		self.disk_size = 0 # bytes on disk
+		self.hits = 0
+		self.disk_hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.loading = {} # key -> event set once the thread decoding it is done
+
+		if (directory):
+			os.makedirs(directory, exist_ok=True)
+			self.load_index()
+
+	@staticmethod
+	def key(path: str) -> str:
+		"""Key of the current content of the file at `path`."""
+		path = os.path.abspath(path)
+		stat = os.stat(path)
+		return f"{path}:{stat.st_mtime_ns}:{stat.st_size}"
+
+	def load_from(self, path: str, workers: int=1, progress=None) -> Image:
+		"""Image of the ULBMP file at `path`, decoded only when it is not cached (see `Decoder.load_from`).
+
+		Concurrent misses on a file are decoded once, the other threads wait for it to be cached.
+		"""
+		key = self.key(path)
+		while True:
+			found = self.lookup(key)
+			if (isinstance(found, Image)):
+				return found
+			if (found is None):
+				break
+			found.wait() # cached by now, unless the decode failed or the image is too large
+
+		try:
+			img = Decoder.load_from(path, workers, progress)
+			with self.lock:
+				self.store(key, img.width, img.height, bytes(img.data))
+		finally:
+			with self.lock:
+				self.loading.pop(key).set()
+		return img
+
+	def lookup(self, key: str) -> Image | threading.Event | None:
+		"""Cached image of `key`, the event of the thread decoding it, or None when the caller must decode it."""
+		with self.lock:
+			if (key in self.memory):
+				self.hits += 1
+				self.memory.move_to_end(key)
+				width, height, data = self.memory[key]
+				return Image(width, height, data)
+			if (key in self.disk):
+				# back to memory, off the disk
+				width, height, name = self.disk.pop(key)
+				try:
+					with open(os.path.join(self.directory, name), 'rb') as file:
+						data = file.read()
+					os.remove(os.path.join(self.directory, name))
+				except OSError:
+					data = b''
+				self.disk_size -= width * height * 3
+				self.save_index()
+				if (len(data) == width * height * 3):
+					self.disk_hits += 1
+					self.store(key, width, height, data)
+					return Image(width, height, data)
+			if (key in self.loading):
+				return self.loading[key]
+			self.misses += 1
+			self.loading[key] = threading.Event()
+			return None
+
+	def store(self, key: str, width: int, height: int, data: bytes) -> None:
+		"""Keep an image in memory, the least recently used ones go to disk (or away) to make room."""
+		if (key in self.memory):
+			self.size -= len(self.memory.pop(key)[2])
+		if (len(data) > self.max_bytes):
+			return
+		self.memory[key] = (width, height, data)
+		self.size += len(data)
+
+		spilled = False
+		while (self.size > self.max_bytes):
+			old, (w, h, old_data) = self.memory.popitem(last=False)
+			self.size -= len(old_data)
+			self.evictions += 1
+			if (self.directory):
+				spilled = self.spill(old, w, h, old_data) or spilled
+		if (spilled):
+			self.save_index()
+
+	def spill(self, key: str, width: int, height: int, data: bytes) -> bool:
+		"""Write an image pushed out of memory to the disk tier, return whether it was."""
+		if (len(data) > self.disk_bytes or key in self.disk):
+			return False
+		name = hashlib.sha1(key.encode()).hexdigest() + '.rgb'
+		with open(os.path.join(self.directory, name), 'wb') as file:
+			file.write(data)
+		self.disk[key] = (width, height, name)
+		self.disk_size += len(data)
+
+		while (self.disk_size > self.disk_bytes):
+			_, (w, h, old) = self.disk.popitem(last=False)
+			self.disk_size -= w * h * 3
+			try:
+				os.remove(os.path.join(self.directory, old))
+			except OSError:
+				pass
+		return True
+
+	def load_index(self) -> None:
+		"""Read the images of the disk tier left by a previous run, missing files are dropped."""
+		try:
+			with open(os.path.join(self.directory, 'index.json'), 'r') as file:
+				entries = json.load(file)
+		except (OSError, ValueError):
+			return
+		for key, width, height, name in entries:
+			if (os.path.exists(os.path.join(self.directory, name))):
+				self.disk[key] = (width, height, name)
+				self.disk_size += width * height * 3
+
+	def save_index(self) -> None:
+		"""Write the list of the images of the disk tier, least recently used first."""
+		path = os.path.join(self.directory, 'index.json')
+		with open(path + '.tmp', 'w') as file:
+			json.dump([[key, width, height, name] for key, (width, height, name) in self.disk.items()], file)
+		os.replace(path + '.tmp', path)
+
+	def close(self) -> None:
+		"""Move the images in memory to the disk tier, for the next run."""
+		if (not self.directory):
+			return
+		with self.lock:
+			for key, (width, height, data) in self.memory.items():
+				self.spill(key, width, height, data)
+			self.memory.clear()
+			self.size = 0
+			self.save_index()
+
+	def clear(self) -> None:
+		"""Forget every image, in memory and on disk."""
+		with self.lock:
+			for _, _, name in self.disk.values():
+				try:
+					os.remove(os.path.join(self.directory, name))
+				except OSError:
+					pass
+			self.memory.clear()
+			self.disk.clear()
+			self.size = self.disk_size = 0
+			if (self.directory):
+				self.save_index()
+
+	def counters(self) -> dict[str, int]:
+		"""Hits (memory and disk), misses, evictions from memory and bytes held."""
+		return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'evictions': self.evictions,
+			'bytes': self.size, 'disk_bytes': self.disk_size, 'images': len(self.memory), 'disk_images': len(self.disk)}
@@ -1,5 +1,18 @@
+import io
+import mmap
+import os
+import re
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress, repeat
+from operator import add, gt, sub
+from multiprocessing.shared_memory import SharedMemory
+from typing import BinaryIO, Iterator
+
 from image import Image
 from pixel import Pixel
+from quantize import quantize
 
 MB = "\u001b[38;2;44;236;246m"
 PINK = "\u001b[38;2;255;126;219m"
@@ -7,6 +20,29 @@ C = "\u001b[0m"
 
 # TODO : map version to method
 
+CHUNKED = 0b10000000 # version flag of v2 / v4 payloads split in independent chunks of rows
+CACHED = 0b01000000 # version flag of v4 payloads using the RUN and INDEX blocks
+RUNS_ONLY = 0b00010000 # with CACHED, version flag of v4 payloads without INDEX blocks (level 1), decoded without the cache
+CHECKSUM = 0b00100000 # version flag of payloads followed by the CRC32 of each CHECK_BLOCK bytes
+CHECK_BLOCK = 1 << 20
+CACHE_SIZE = 63 # v4 recently seen colors, one INDEX block each (0b11000000 to 0b11111110)
+SAMPLE = 1 << 18 # pixels encoded to estimate the size of a v4 payload
+REPEAT = bytes([1, 0] + [1] * 254) # flags RLE counts other than 1
+RUN = re.compile(b'\x01')
+
+SAME = re.compile(b'[\x2a]+') # ULBMP_SMALL_DIFF bytes of an unchanged pixel
+# ULBMP_SMALL_DIFF byte -> (∆R, ∆G, ∆B)
+SMALL_DIFF = [((byte >> 4 & 0b11) - 2, (byte >> 2 & 0b11) - 2, (byte & 0b11) - 2) for byte in range(256)]
+# second byte of ULBMP_INTERMEDIATE_DIFF -> (∆R,G, ∆B,G)
+INTERMEDIATE_DIFF = [((byte >> 4) - 8, (byte & 0b1111) - 8) for byte in range(256)]
+# v4 blocks, and the RUN blocks after the other blocks before them (see `Reader.count_pixels`)
+BLOCKS = re.compile(rb'[\x00-\x3f]|[\x40-\x7f][\s\S]|[\x80-\xfe][\s\S]{2}|\xff[\s\S]{3}')
+CACHED_BLOCKS = re.compile(rb'[\x00-\x3f\xc0-\xfe]|[\x40-\x7f][\s\S]|[\x80-\xaf][\s\S]{2}|\xff[\s\S]{3}|[\xb0-\xbf][\s\S]')
+RUNS = re.compile(rb'(?:[\x00-\x3f\xc0-\xfe]|[\x40-\x7f][\s\S]|[\x80-\xaf][\s\S]{2}|\xff[\s\S]{3})*+([\xb0-\xbf][\s\S])?')
+# whole v4 blocks from a position, the match ends before a block cut short
+STREAM = re.compile(b'(?:' + BLOCKS.pattern + b')*+')
+CACHED_STREAM = re.compile(b'(?:' + CACHED_BLOCKS.pattern + b')*+')
+
 class Encoder:
 	"""Encodes an image to the ULBMP format."""
 	def __init__(self, img: Image, version: int=1, **kwargs): # TODO : version 3, 4 # FIXME : asked __init__(self, img: Image)
@@ -15,15 +51,30 @@ class Encoder:
 		self.depth = kwargs.get('depth', 0)
 		self.rle: bool = kwargs.get('rle', 0)
 		self.colors = kwargs.get('colors', 0)
+		self.chunk_rows = kwargs.get('chunk_rows', 0) # rows per chunk, 0 for a single stream
+		self.level = kwargs.get('level', 0) # v4 compression: 0 plain, 1 RUN blocks, 2 RUN and INDEX blocks
+		self.checksum = kwargs.get('checksum', False) # CRC32 of each CHECK_BLOCK bytes of the payload after it
+		self.progress = kwargs.get('progress') # called with (rows encoded, rows) as rows are encoded, may raise to stop
 
-		if (self.version == 3 and not self.colors): # For tester...
-			'''get a set of colors from the image'''
-			self.colors = set()
+		if (self.version == 3 and kwargs.get('quantize') and not self.colors and img is not None and 0 < self.depth <= 8):
+			# more colors than the palette holds: encode the image reduced to a palette of that size
+			if (len(img.stats.colors(1 << self.depth)) > 1 << self.depth):
+				self.img, self.colors = quantize(img, 1 << self.depth, kwargs.get('dither'))
+		if (self.version == 3 and not self.colors and img is not None and self.depth <= 8): # For tester...
+			'''get a set of colors from the image, the scan stops past the size of the palette'''
+			self.colors = self.img.stats.palette(1 << self.depth if (self.depth) else None)
 
-			for y in range(self.img.height):
-				for x in range(self.img.width):
-					pixel = self.img[x, y]
-					self.colors.add(pixel)
+		# state of the payload carried from a block of pixels to the next one
+		self.run = None # open RLE run (symbol, length)
+		self.carry = b'' # v3 palette indices that do not fill a byte yet
+		self.old = (0, 0, 0) # v4 previous pixel
+		self.same = 0 # v4 repeats of the previous pixel not written yet
+		self.cache = [0] * CACHE_SIZE # v4 recently seen colors, `red << 16 | green << 8 | blue`
+
+	@staticmethod
+	def begin(path: str, width: int, height: int, version: int=1, **kwargs) -> 'Writer':
+		"""Start writing an image to a file in the ULBMP format row by row, see `Writer`."""
+		return Writer(path, width, height, version, **kwargs)
 
 	def write_pixel(self, file, pixel: Pixel, ppb: int=1) -> None:
 		"""Write a pixel to the file.
@@ -33,184 +84,682 @@ class Encoder:
 		file.write(pixel.green.to_bytes(ppb, byteorder='little'))
 		file.write(pixel.blue.to_bytes(ppb, byteorder='little'))
 
-	def v1(self, file) -> None:
+	def header(self, width: int, height: int) -> bytearray:
+		"""Header of the file, the parameters are checked before anything is written."""
+		if (self.version not in (1, 2, 3, 4)):
+			raise Exception(f'Unsupported version {self.version}')
+		if (width <= 0 or height <= 0):
+			raise Exception('Invalid dimensions')
+
+		if (self.chunk_rows and (self.version not in (2, 4) or not 0 < self.chunk_rows < 1 << 16)):
+			raise Exception('Chunks are only supported by versions 2 and 4, with 1 to 65535 rows')
+		if (self.level not in (0, 1, 2) or (self.level and self.version != 4)):
+			raise Exception('Compression levels are only supported by version 4, from 0 to 2')
+
+		version = self.version
+		if (self.chunk_rows):
+			version |= CHUNKED
+		if (self.level):
+			version |= CACHED
+		if (self.level == 1):
+			version |= RUNS_ONLY
+		if (self.checksum):
+			version |= CHECKSUM
+		header = bytearray(b"ULBMP")
+		header += version.to_bytes(1, byteorder='little') # 1.0 version
+		header_len = 12 # header size 12 little endian
+
+		if (self.chunk_rows):
+			# rows per chunk and offset of each chunk in the payload (4 bytes)
+			header_len = 14 + 4 * -(-height // self.chunk_rows)
+
+		if (self.version == 3):
+			self.colors = list(self.colors or [])
+
+			if (self.depth < 1 or self.depth > 24):
+				raise Exception('Invalid depth')
+			if (self.depth <= 8 and len(self.colors) > (1 << self.depth)):
+				raise Exception(f'Invalid number of colors. \nGot {len(self.colors)} or more\nExpected {1 << self.depth}')
+
+			header_len = 14 + len(self.colors) * 3 if (self.depth <= 8) else 14
+			# color -> palette index lookup table, keyed like Image.packed()
+			self.index = {color.rgb: i for i, color in enumerate(self.colors)}
+
+		header += header_len.to_bytes(2, byteorder='little')
+		header += width.to_bytes(2, byteorder='little')
+		header += height.to_bytes(2, byteorder='little')
+
+		if (self.chunk_rows):
+			header += self.chunk_rows.to_bytes(2, byteorder='little')
+			header += bytes(header_len - len(header)) # offsets, written once known
+		if (self.version == 3):
+			header += self.depth.to_bytes(1, byteorder='little')
+			header += int(self.rle).to_bytes(1, byteorder='little')
+			if (self.depth <= 8):
+				for color in self.colors:
+					header += bytes((color.red, color.green, color.blue))
+		return header
+
+	def encode(self, file, data: bytes) -> None:
+		"""Write the payload of a block of pixels (packed RGB, following the previous block)."""
+		match self.version:
+			case 1:
+				self.v1(file, data)
+			case 2:
+				self.v2(file, data)
+			case 3:
+				self.v3(file, data)
+			case 4:
+				self.v4(file, data)
+			case _:
+				raise Exception(f'Unsupported version {self.version}')
+
+	def finish(self, file) -> None:
+		"""Write what the last block of pixels left open: a pending run or a partly filled byte."""
+		if (self.run):
+			symbol, length = self.run
+			file.write(length.to_bytes(1, byteorder='little') + symbol)
+			self.run = None
+		if (self.carry):
+			file.write(self.pack_bits(self.carry, self.depth))
+			self.carry = b''
+		if (self.same):
+			out = bytearray()
+			self.v4_run(self.same, out)
+			file.write(out)
+			self.same = 0
+
+	def restart(self, file) -> None:
+		"""End a chunk of rows: the next pixels are encoded without reference to the previous ones."""
+		self.finish(file)
+		self.old = (0, 0, 0)
+		self.cache = [0] * CACHE_SIZE
+
+	def to_bytes(self) -> bytes:
+		"""The whole image encoded in memory, header included."""
+		file = io.BytesIO()
+		self.save_to(file)
+		return file.getvalue()
+
+	def v1(self, file, data: bytes) -> None:
 		"""version 1.0 of the ULBMP format"""
-		for pixel in self.img.pixels:
-			self.write_pixel(file, pixel)
+		file.write(data)
 
-	def v2(self, file, ppb: int=1) -> None:
+	def v2(self, file, data: bytes) -> None:
 		"""version 2.0 of the ULBMP format using Run-Length Encoding"""
-		i = 0
+		self.runs(file, data, 3)
 
-		while i < len(self.img.pixels):
-			pixel = self.img.pixels[i]
-			run_length = 1
-			# fix overflow run_length < 255
-			while run_length < 255 and (i + run_length) < len(self.img.pixels) and self.img.pixels[i + run_length] == pixel: # TODO : check if run_length < 255 1 byte
-				run_length += 1
+	def runs(self, file, data: bytes, size: int) -> None:
+		"""Write the (run length, symbol) records of the `size` bytes symbols of `data`.
 
-			file.write(run_length.to_bytes(1, byteorder='little'))
-			self.write_pixel(file, pixel, ppb)
-			i += run_length
+		The runs start where a symbol (a pixel or a palette index) differs from the previous one:
+		the block XORed with itself shifted by one symbol, as two big integers, is zero everywhere
+		else. Runs over 255 get extra starts every 255 symbols, the records are then laid out
+		column by column in one buffer.
+		The last run is kept open in `self.run`, the next block of pixels can go on with it.
+		"""
+		if (self.run):
+			symbol, length = self.run
+			data = symbol * length + data
+		if (not data):
+			return
 
-	def v3(self, file) -> None:
+		count = len(data) // size
+		diff = (int.from_bytes(data[size:]) ^ int.from_bytes(data[:-size])).to_bytes(len(data) - size)
+		if (size > 1):
+			# a byte per symbol, not zero if any of its bytes changed
+			changed = 0
+			for c in range(size):
+				changed |= int.from_bytes(diff[c::size])
+			diff = changed.to_bytes(count - 1)
+		starts = [0, *compress(range(1, count), diff)]
+		lengths = list(map(sub, starts[1:] + [count], starts))
+		if (max(lengths) > 255):
+			long = compress(zip(starts, lengths), map(gt, lengths, repeat(255)))
+			starts = sorted(starts + [i for start, length in long for i in range(start + 255, start + length, 255)])
+			lengths = list(map(sub, starts[1:] + [count], starts))
+
+		last = starts.pop()
+		self.run = (bytes(data[last * size:(last + 1) * size]), lengths.pop())
+		if (not starts):
+			return
+
+		record = size + 1
+		out = bytearray(len(starts) * record)
+		out[0::record] = bytes(lengths)
+		for c in range(size):
+			out[c + 1::record] = bytes(map(data[c::size].__getitem__, starts))
+		file.write(out)
+
+	def v3(self, file, data: bytes) -> None:
 		"""version 3.0 of the ULBMP format"""
-		self.colors = list(self.colors)
-		
-		if (self.depth < 1 or self.depth > 24):
-			raise Exception('Invalid depth')
-		if (self.depth <= 8 and len(self.colors) > (1 << self.depth)):
-			raise Exception(f'Invalid number of colors. \nGot {len(self.colors)}\nExpected {1 << self.depth}')
-		
 		if (self.depth > 8):
-			self.v1(file) if (not self.rle) else self.v2(file)
+			self.v1(file, data) if (not self.rle) else self.v2(file, data)
 			return
 
-		pixels_per_byte = 8 // self.depth
-		total_pixels = self.img.width * self.img.height
-		pixels = self.img.pixels
+		try:
+			pixels = bytes(map(self.index.__getitem__, Image.pack_ints(data)))
+		except KeyError:
+			raise Exception('Color not in palette')
 
 		if self.depth == 8 and self.rle:
 			# Run-Length Encoding
-			i = 0
-			while i < total_pixels:
-				run_val = pixels[i]
-				run_len = 1
-
-				while (i + run_len < total_pixels) and (pixels[i + run_len] == run_val) and (run_len < 255):
-					run_len += 1
-
-				file.write(run_len.to_bytes(1, byteorder='little'))  # Write run length
-				file.write(self.colors.index(run_val).to_bytes(1, byteorder='little'))  # Write run value
-
-				i += run_len
+			self.runs(file, pixels, 1)
 		else:
-			for i in range(0, total_pixels, pixels_per_byte):
-				byte = 0
+			pixels = self.carry + pixels
+			end = len(pixels) - len(pixels) % (8 // self.depth)
+			self.carry = pixels[end:]
+			file.write(self.pack_bits(pixels[:end], self.depth))
+
+	@staticmethod
+	def pack_bits(indices: bytes, depth: int) -> bytes:
+		"""Pack palette indices of `depth` bits, 8 // depth per byte, first pixel in the high bits.
 
-				for j in range(pixels_per_byte):
-					if (i + j >= total_pixels):
-						break
+		Each column of the output (pixel j of every byte) is shifted in one `translate`
+		and the columns are or'ed together as big integers.
+		"""
+		pixels_per_byte = 8 // depth
+		if (pixels_per_byte == 1):
+			return indices
 
-					byte |= (self.colors.index(pixels[i + j]) << ((pixels_per_byte - 1 - j) * self.depth))
-				
-				file.write(byte.to_bytes(1, byteorder='little'))
+		size = -(-len(indices) // pixels_per_byte)
+		indices = indices.ljust(size * pixels_per_byte, b'\x00')
+		packed = 0
+		for j in range(pixels_per_byte):
+			shift = (pixels_per_byte - 1 - j) * depth
+			column = indices[j::pixels_per_byte].translate(bytes((i << shift) & 0xff for i in range(256)))
+			packed |= int.from_bytes(column, byteorder='big')
+		return packed.to_bytes(size, byteorder='big')
 
-	def v4_bigDiff(self, type, DM, D2, D3, file) -> None:
+	def v4_bigDiff(self, type, DM, D2, D3, out: bytearray) -> None:
 		"""version 4.0 Big Block of the ULBMP format using QOL approach"""
 		byte = type | ((DM + 128) & 0b11110000) >> 4
 		byte1 = ((DM + 128) & 0b00001111) << 4 | ((D2 - DM + 32) & 0b111100) >> 2
 		byte2 = ((D2 - DM + 32) & 0b00000011) << 6 | ((D3 - DM + 32) & 0b00111111)
 		# print(bin(byte), bin(byte1), bin(byte2))
-		file.write(byte.to_bytes(1, byteorder='little'))
-		file.write(byte1.to_bytes(1, byteorder='little'))
-		file.write(byte2.to_bytes(1, byteorder='little'))
-
-	def v4(self, file) -> None:
-		"""version 4.0 of the ULBMP format using QOL approach"""
-		oldPixel = Pixel(0, 0, 0)
-		for pixel in self.img.pixels:
-			Dr = pixel.red - oldPixel.red
-			Dg = pixel.green - oldPixel.green
-			Db = pixel.blue - oldPixel.blue
+		out += bytes((byte, byte1, byte2))
+
+	@staticmethod
+	def v4_run(count: int, out: bytearray) -> None:
+		"""ULBMP_RUN blocks of `count` repeats of the previous pixel, SMALL_DIFF (0, 0, 0) for 1 or 2."""
+		while count >= 3:
+			run = min(count, 4096)
+			out += bytes((0b10110000 | (run - 1) >> 8, (run - 1) & 0b11111111))
+			count -= run
+		out += b'\x2a' * count
+
+	def v4(self, file, data: bytes) -> None:
+		"""version 4.0 of the ULBMP format using QOL approach
+
+		From level 1, repeats of the previous pixel are gathered in RUN blocks, from level 2 a color
+		of the cache of recently seen colors is written as its INDEX. Every pixel has a single best
+		block whatever comes next (the decoder ends up in the same state), so the blocks are picked
+		greedily by size.
+		"""
+		out = bytearray()
+		oldR, oldG, oldB = self.old
+		level = self.level
+		same = self.same
+		cache = self.cache
+		for i in range(0, len(data), 3):
+			r, g, b = data[i], data[i+1], data[i+2]
+			if (level and r == oldR and g == oldG and b == oldB):
+				same += 1
+				continue
+			if (same):
+				self.v4_run(same, out)
+				same = 0
+			Dr = r - oldR
+			Dg = g - oldG
+			Db = b - oldB
 			if -2 <= Dr <= 1 and -2 <= Dg <= 1 and -2 <= Db <= 1:
 				# ULBMP_SMALL_DIFF
-				byte = (Dr + 2) << 4 | ((Dg + 2) << 2) | ((Db + 2))
-				file.write(byte.to_bytes(1, byteorder='little'))
+				out.append((Dr + 2) << 4 | ((Dg + 2) << 2) | ((Db + 2)))
+			elif (level == 2 and cache[(r * 3 + g * 5 + b * 7) % CACHE_SIZE] == r << 16 | g << 8 | b):
+				# ULBMP_INDEX
+				out.append(0b11000000 | (r * 3 + g * 5 + b * 7) % CACHE_SIZE)
 			elif (-32 <= Dg <= 31) and (-8 <= Dr - Dg <= 7 and -8 <= Db - Dg <= 7):
 				# ULBMP_INTERMEDIATE_DIFF
-				byte = (1 << 6) | (Dg + 32)
-				byte1 = ((Dr - Dg + 8) << 4) | (Db - Dg + 8)
-				file.write(byte.to_bytes(1, byteorder='little'))
-				file.write(byte1.to_bytes(1, byteorder='little'))
+				out.append((1 << 6) | (Dg + 32))
+				out.append(((Dr - Dg + 8) << 4) | (Db - Dg + 8))
 			elif (-128 <= Dr <= 127) and (-32 <= Dg - Dr <= 31 and -32 <= Db - Dr <= 31):
 				# ULBMP_BIG_DIFF red
-				self.v4_bigDiff(0b10000000, Dr, Dg, Db, file)
+				self.v4_bigDiff(0b10000000, Dr, Dg, Db, out)
 			elif (-128 <= Dg <= 127) and (-32 <= Dr - Dg <= 31 and -32 <= Db - Dg <= 31):
 				# ULBMP_BIG_DIFF green
-				self.v4_bigDiff(0b10010000, Dg, Dr, Db, file)
+				self.v4_bigDiff(0b10010000, Dg, Dr, Db, out)
 			elif (-128 <= Db <= 127) and (-32 <= Dr - Db <= 31 and -32 <= Dg - Db <= 31):
 				# ULBMP_BIG_DIFF blue
-				self.v4_bigDiff(0b10100000, Db, Dr, Dg, file)
+				self.v4_bigDiff(0b10100000, Db, Dr, Dg, out)
 			else:
 				# ULBMP_NEW_PIXEL
-				file.write((0b11111111).to_bytes(1, byteorder='little'))
-				self.write_pixel(file, pixel)
-			oldPixel = pixel
-
-	def save_to(self, path: str) -> None:
-		"""Save the image to a file in the ULBMP format."""
-		with open(path, 'wb') as file:
-			# TODO : write header function
-			file.write(b"ULBMP")
-			file.write(self.version.to_bytes(1, byteorder='little')) # 1.0 version
-			if (self.version == 3):
-				if (self.depth <= 8):
-					file.write((14 + len(self.colors) * 3).to_bytes(2, byteorder='little'))
-				else:
-					file.write((14).to_bytes(2, byteorder='little'))
+				out.append(0b11111111)
+				out += data[i:i+3]
+			if (level == 2):
+				cache[(r * 3 + g * 5 + b * 7) % CACHE_SIZE] = r << 16 | g << 8 | b
+			oldR, oldG, oldB = r, g, b
+		self.old = (oldR, oldG, oldB)
+		self.same = same
+		file.write(out)
+
+	def save_to(self, path: str | BinaryIO, workers: int=1) -> None:
+		"""Save the image to a file in the ULBMP format, or to a seekable binary file object.
+
+		With `workers` > 1, v3 without RLE is encoded by bands of pixels in a process pool.
+		A file at `path` is removed if the encoding fails or is stopped by `progress`.
+		"""
+		if (workers > 1 and self.version == 3 and self.depth <= 8 and not (self.depth == 8 and self.rle)):
+			return self.save_bands(path, workers)
+
+		try:
+			with Writer(path, self.img.width, self.img.height, self.version, depth=self.depth, rle=self.rle, colors=self.colors,
+				chunk_rows=self.chunk_rows, level=self.level, checksum=self.checksum, progress=self.progress) as writer:
+				writer.write_rows(self.img.data)
+		except BaseException:
+			if (isinstance(path, (str, os.PathLike)) and os.path.exists(path)):
+				os.remove(path)
+			raise
+
+	def save_bands(self, path: str | BinaryIO, workers: int) -> None:
+		"""Save the image with its v3 palette indices packed by `workers` processes.
+
+		The image is shared with the workers, each band starts on a byte of the payload.
+		"""
+		header = self.header(self.img.width, self.img.height)
+		total_pixels = self.img.width * self.img.height
+		pixels_per_byte = 8 // self.depth
+		bands = [total_pixels * k // workers // pixels_per_byte * pixels_per_byte for k in range(workers)] + [total_pixels]
+
+		shm = SharedMemory(create=True, size=len(self.img.data))
+		try:
+			shm.buf[:len(self.img.data)] = self.img.data
+			with ProcessPoolExecutor(workers) as pool:
+				parts = pool.map(encode_band, repeat(shm.name), bands[:-1], bands[1:], repeat(self.depth), repeat(self.index))
+				file = open(path, 'wb') if (isinstance(path, (str, os.PathLike))) else path
+				try:
+					file.write(header)
+					checksums = Checksums()
+					for part in parts:
+						file.write(part)
+						checksums.update(part)
+					if (self.checksum):
+						file.write(checksums.trailer())
+				finally:
+					if (file is not path):
+						file.close()
+		finally:
+			shm.close()
+			shm.unlink()
+
+	@staticmethod
+	def predict(img: Image, level: int=2) -> list[tuple[int, int, dict]]:
+		"""(size in bytes, version, keyword arguments) of every way to encode the image, smallest first.
+
+		The image is analysed once: its palette and its runs of equal pixels give the exact size
+		of v1, v2 and v3 at each legal depth with and without RLE, v4 (at `level`) is estimated
+		by encoding bands of rows spread over the image.
+		"""
+		pixels = img.width * img.height
+		colors = img.stats.colors(256)
+		records = img.stats.records() # (run length, color) records, runs longer than 255 are split
+		palette = img.stats.palette(256) if (len(colors) <= 256) else []
+
+		candidates = [(12 + pixels * 3, 1, {}), (12 + records * 4, 2, {})]
+		for depth in (1, 2, 4, 8):
+			if (len(colors) <= 1 << depth):
+				candidates.append((14 + len(colors) * 3 + -(-pixels * depth // 8), 3, {'depth': depth, 'colors': palette}))
+		if (len(colors) <= 256):
+			candidates.append((14 + len(colors) * 3 + records * 2, 3, {'depth': 8, 'rle': True, 'colors': palette}))
+		candidates.append((14 + pixels * 3, 3, {'depth': 24}))
+		candidates.append((14 + records * 4, 3, {'depth': 24, 'rle': True}))
+		candidates.append((Encoder.estimate_v4(img, level), 4, {'level': level} if (level) else {}))
+		return sorted(candidates, key=lambda candidate: candidate[0])
+
+	@staticmethod
+	def estimate_v4(img: Image, level: int=0) -> int:
+		"""Size of the image in v4 at `level`, exact up to SAMPLE pixels, else from 16 rows bands."""
+		row_len = img.width * 3
+		band = img.height if (img.width * img.height <= SAMPLE) else min(img.height, 16)
+		bands = max(1, min(img.height // band, SAMPLE // (img.width * band)))
+		encoder = Encoder(None, 4, level=level)
+		file = io.BytesIO()
+
+		for k in range(bands):
+			y = (img.height - band) * k // max(1, bands - 1)
+			encoder.restart(file)
+			encoder.encode(file, img.data[y * row_len:(y + band) * row_len])
+		encoder.finish(file)
+		return 12 + file.tell() * img.height // (bands * band)
+
+	@staticmethod
+	def auto(img: Image, level: int=2, trials: int=0, workers: int=1) -> 'Encoder':
+		"""Encoder of the image in its smallest format, see `predict`.
+
+		With `trials` > 0, the best predicted candidates are encoded (by `workers` processes)
+		and the smallest output wins, for when the v4 estimate is close to another format.
+		"""
+		candidates = Encoder.predict(img, level)
+		if (trials > 0):
+			candidates = candidates[:trials]
+			versions = [version for _, version, _ in candidates]
+			options = [kwargs for _, _, kwargs in candidates]
+			if (workers > 1):
+				with ProcessPoolExecutor(workers) as pool:
+					sizes = list(pool.map(encoded_size, repeat(img), versions, options))
 			else:
-				file.write((12).to_bytes(2, byteorder='little')) # header size 12 little endian
-			file.write(self.img.width.to_bytes(2, byteorder='little'))
-			file.write(self.img.height.to_bytes(2, byteorder='little'))
-
-			match self.version:
-				case 1:
-					self.v1(file)
-				case 2:
-					self.v2(file)
-				case 3:
-					file.write(self.depth.to_bytes(1, byteorder='little'))
-					file.write(self.rle.to_bytes(1, byteorder='little'))
-					if (self.depth <= 8):
-						for color in self.colors:
-							self.write_pixel(file, color)
-					self.v3(file)
-				case 4:
-					self.v4(file)
-				case _:
-					raise Exception(f'Unsupported version {self.version}') # TODO : raise before writing
+				sizes = list(map(encoded_size, repeat(img), versions, options))
+			candidates = [(size, version, kwargs) for size, (_, version, kwargs) in zip(sizes, candidates)]
+		_, version, kwargs = min(candidates, key=lambda candidate: candidate[0])
+		return Encoder(img, version, **kwargs)
+
+def encoded_size(img: Image, version: int, kwargs: dict) -> int:
+	"""Size of the image encoded in `version` with `kwargs`, nothing is written."""
+	encoder = Encoder(img, version, **kwargs)
+	file = io.BytesIO()
+	header = encoder.header(img.width, img.height)
+	file.write(header)
+	encoder.encode(file, img.data)
+	encoder.finish(file)
+	if (encoder.checksum):
+		return file.tell() + 4 * -(-(file.tell() - len(header)) // CHECK_BLOCK)
+	return file.tell()
+
+def read_source(source: str | bytes | BinaryIO) -> str | bytes:
+	"""A path as is, the content of a buffer or of a binary file object (read to its end) as bytes."""
+	if (isinstance(source, (str, os.PathLike, bytes, bytearray))):
+		return source
+	if (isinstance(source, memoryview)):
+		return source.tobytes()
+	return source.read()
+
+def encode_band(name: str, start: int, stop: int, depth: int, index: dict[int, int]) -> bytes:
+	"""Packed v3 palette indices of the pixels `start` to `stop` of the image in the shared memory `name`."""
+	shm = SharedMemory(name)
+	try:
+		data = shm.buf[start * 3:stop * 3].tobytes()
+	finally:
+		shm.close()
+
+	try:
+		pixels = bytes(map(index.__getitem__, Image.pack_ints(data)))
+	except KeyError:
+		raise Exception('Color not in palette')
+	return Encoder.pack_bits(pixels, depth)
+
+def decode_band(path: str, name: str, y0: int, y1: int) -> None:
+	"""Decode the rows `y0` to `y1` of the file at `path` into the shared memory `name`."""
+	shm = SharedMemory(name)
+	try:
+		with Reader(path) as reader:
+			rows = reader.rows(y0, y1)
+			shm.buf[y0 * reader.row_len:y1 * reader.row_len] = rows
+			if (isinstance(rows, memoryview)):
+				rows.release()
+	finally:
+		shm.close()
+
+class Checksums:
+	"""CRC32 of each CHECK_BLOCK bytes of a payload, fed as it is written (the last block can be shorter)."""
+	def __init__(self, payload: bytes=b''):
+		self.sums = bytearray()
+		self.crc = 0
+		self.pending = 0 # bytes of the current block
+		self.update(payload)
+
+	def update(self, data: bytes) -> None:
+		view = memoryview(data)
+		while view:
+			size = min(len(view), CHECK_BLOCK - self.pending)
+			self.crc = zlib.crc32(view[:size], self.crc)
+			self.pending += size
+			view = view[size:]
+			if (self.pending == CHECK_BLOCK):
+				self.sums += self.crc.to_bytes(4, byteorder='little')
+				self.crc, self.pending = 0, 0
+
+	def trailer(self) -> bytes:
+		"""The checksums to write after the payload."""
+		if (self.pending):
+			self.sums += self.crc.to_bytes(4, byteorder='little')
+			self.crc, self.pending = 0, 0
+		return bytes(self.sums)
+
+	@staticmethod
+	def trailer_len(size: int) -> int:
+		"""Length of the checksums at the end of `size` bytes of payload and checksums."""
+		return 4 * -(-size // (CHECK_BLOCK + 4))
+
+class Writer(Encoder):
+	"""Encodes an image to the ULBMP format from its rows, as they come.
+
+	The output is gathered in a preallocated buffer of `chunk` bytes, written to the file
+	each time it is full. Version 3 with a depth of 8 or less needs its `colors` up front.
+	With `chunk_rows`, the chunk offsets are written in the header when the file is closed.
+	`path` can also be a binary file object, left open (it must be seekable with `chunk_rows`).
+	"""
+	def __init__(self, path: str | BinaryIO, width: int, height: int, version: int=1, chunk: int=1 << 20, **kwargs):
+		super().__init__(None, version, **kwargs)
+		if (self.version == 3 and self.depth <= 8 and not self.colors):
+			raise Exception('No colors given for the palette')
+
+		header = self.header(width, height)
+		self.width = width
+		self.height = height
+		self.y = 0 # rows written
+		self.buffer = bytearray(chunk)
+		self.pos = 0
+		self.size = 0 # bytes written, header included
+		self.checksums = None
+		self.owned = isinstance(path, (str, os.PathLike)) # the file is closed with the writer
+		self.file = open(path, 'wb') if (self.owned) else path
+		self.start = 0 if (self.owned) else self.file.tell()
+		self.write(header)
+		self.header_len = len(header)
+		if (self.checksum):
+			self.checksums = Checksums()
+		self.offsets = [0] if (self.chunk_rows) else []
+
+	def write(self, data: bytes) -> None:
+		"""Copy `data` to the buffer, the buffer is written to the file once full."""
+		size = len(data)
+		self.size += size
+		if (self.checksums is not None):
+			self.checksums.update(data)
+		if (self.pos + size > len(self.buffer)):
+			self.flush()
+		if (size >= len(self.buffer)):
+			self.file.write(data)
+			return
+		self.buffer[self.pos:self.pos + size] = data
+		self.pos += size
+
+	def flush(self) -> None:
+		self.file.write(memoryview(self.buffer)[:self.pos])
+		self.pos = 0
+
+	def write_rows(self, rows) -> None:
+		"""Encode rows of packed RGB, given as one buffer of whole rows or an iterable of them (e.g. a generator).
+
+		Large buffers are encoded a chunk at a time.
+		"""
+		if (isinstance(rows, (bytes, bytearray, memoryview))):
+			rows = (rows,)
+
+		row_len = self.width * 3
+		step = max(1, len(self.buffer) // row_len)
+		for data in rows:
+			view = memoryview(data)
+			if (len(view) % row_len or self.y + len(view) // row_len > self.height):
+				raise Exception('Invalid number of pixels')
+
+			i = 0
+			while i < len(view):
+				count = min(step, (len(view) - i) // row_len)
+				if (self.chunk_rows):
+					if (self.y and self.y % self.chunk_rows == 0):
+						self.restart(self)
+						self.offsets.append(self.size - self.header_len)
+					count = min(count, self.chunk_rows - self.y % self.chunk_rows)
+
+				block = view[i:i + count * row_len]
+				self.encode(self, block if (self.version == 1) else block.tobytes())
+				self.y += count
+				i += count * row_len
+				if (self.progress):
+					self.progress(self.y, self.height)
+
+	def close(self) -> None:
+		"""Write the end of the payload and close the file."""
+		try:
+			if (self.y != self.height):
+				raise Exception('Invalid number of pixels')
+			self.finish(self)
+			self.flush()
+			if (self.checksums is not None):
+				self.file.write(self.checksums.trailer())
+			if (self.chunk_rows):
+				end = self.file.tell()
+				self.file.seek(self.start + 14)
+				self.file.write(b''.join(offset.to_bytes(4, byteorder='little') for offset in self.offsets))
+				self.file.seek(end)
+		finally:
+			if (self.owned):
+				self.file.close()
+
+	def __enter__(self) -> 'Writer':
+		return self
+
+	def __exit__(self, type, value, traceback) -> None:
+		if (type is None):
+			self.close()
+		elif (self.owned):
+			self.file.close()
 
 class Decoder: # for tester...
 	@staticmethod
-	def load_from(path: str) -> Image:
-		"""Load an image from a file in the ULBMP format."""
-		return Decoder1().load_from(path)
+	def load_from(path: str | bytes | BinaryIO, workers: int=1, progress=None, region: tuple[int, int, int, int]=None, scale: float=1) -> Image:
+		"""Load an image from a file in the ULBMP format, its content or a binary file object."""
+		return Decoder1().load_from(path, workers, progress, region, scale)
+
+	@staticmethod
+	def probe(path: str | bytes | BinaryIO) -> 'Decoder1':
+		"""Header of a file in the ULBMP format (version, width, height, depth, palette...), only the header is read.
+
+		`path` can also be the content of a file, or a seekable binary file object read from its position.
+		"""
+		decoder = Decoder1()
+		if (isinstance(path, (bytes, bytearray, memoryview))):
+			header_len = int.from_bytes(path[6:8], byteorder='little')
+			decoder.read_header(bytes(path[:max(header_len, 14)]), len(path))
+			return decoder
+
+		file = open(path, 'rb') if (isinstance(path, (str, os.PathLike))) else path
+		try:
+			start = file.tell()
+			size = file.seek(0, 2) - start
+			file.seek(start)
+			header = file.read(14)
+			header_len = int.from_bytes(header[6:8], byteorder='little')
+			if (header_len > len(header)):
+				header += file.read(header_len - len(header))
+		finally:
+			if (file is not path):
+				file.close()
+		decoder.read_header(header, size)
+		return decoder
+
+	@staticmethod
+	def verify(path: str | bytes | BinaryIO) -> 'Decoder1':
+		"""Check a file in the ULBMP format (or its content) without decoding its pixels (see `Reader.verify`), return its header."""
+		with Reader(path) as reader:
+			reader.verify()
+		return reader
+
+	@staticmethod
+	def open(path: str | bytes | BinaryIO) -> 'Reader':
+		"""Open a file in the ULBMP format for lazy row access, only its header is read."""
+		return Reader(path)
 
 class Decoder1: # TODO : static methode
 	"""Decodes an image from the ULBMP format."""
-	def load_from(self, path: str) -> Image:
-		"""Load an image from a file in the ULBMP format."""
+	def load_from(self, path: str | bytes | BinaryIO, workers: int=1, progress=None, region: tuple[int, int, int, int]=None, scale: float=1) -> Image:
+		"""Load an image from a file in the ULBMP format, its content or a binary file object (read to its end).
+
+		With `workers` > 1, v1, v3 without RLE and chunked v2 / v4 are decoded by bands of rows
+		in a process pool. With `progress`, the image is decoded by bands of rows and
+		`progress(rows decoded, rows)` is called after each one, it may raise to stop.
+		With a `region` (x, y, width, height) and / or a `scale` of 1 / k, only that part of the
+		image is loaded, shrunk k times, see `Reader.load_region`.
+		"""
 		# if (path.endswith('.ulbmp') == False): # removed for tester...
 		# 	raise Exception('Invalid file format')
+
+		path = read_source(path)
+		if (region is not None or scale != 1):
+			with Reader(path) as reader:
+				return reader.load_region(region, scale, progress)
+		if (progress):
+			with Reader(path) as reader:
+				return reader.load(progress)
+		if (workers > 1 and isinstance(path, (str, os.PathLike))):
+			with Reader(path) as reader:
+				if (reader.fixed_stride() or reader.chunk_rows):
+					return reader.load_bands(workers)
 		
 		# read bytes from file
-		with open(path, 'rb') as file:
-			bytes = file.read()
-			self.read_header(bytes)
-			pixels = self.read_pixels(bytes)
-			return Image(self.width, self.height, pixels)
+		if (isinstance(path, (str, os.PathLike))):
+			with open(path, 'rb') as file:
+				path = file.read()
+		self.read_header(path)
+		pixels = self.read_pixels(path)
+		return Image(self.width, self.height, pixels)
 
-	def v1(self, bytes: bytes) -> list[Pixel]:
-		"""version 1.0 of the ULBMP format"""
-		pixels = []
-
-		for i in range(self.header_len, len(bytes), 3):
-			pixels.append(Pixel(bytes[i], bytes[i+1], bytes[i+2]))
+	def v1(self, bytes: bytes) -> bytearray:
+		"""version 1.0 of the ULBMP format
 
-		return pixels
+		The payload already is the packed RGB buffer, it is copied once without parsing.
+		"""
+		return bytearray(memoryview(bytes)[self.header_len:self.end])
 	
-	def v2(self, bytes: bytes) -> list[Pixel]:
-		"""version 2.0 of the ULBMP format"""
-		pixels = []
+	def v2(self, bytes: bytes) -> bytearray:
+		"""version 2.0 of the ULBMP format
+
+		Records are (count, r, g, b): the count column is dropped from the payload in bulk,
+		which leaves the packed colors, then only the records with a count other than 1
+		are repeated by their count.
+		"""
+		return self.runs(memoryview(bytes)[self.header_len:self.end])
 
-		for i in range(self.header_len, len(bytes), 4):
-			for j in range(bytes[i]):
-				pixels.append(Pixel(bytes[i+1], bytes[i+2], bytes[i+3]))
+	def runs(self, payload: memoryview) -> bytearray:
+		"""Packed RGB of the v2 (count, r, g, b) records in `payload`."""
+		runs = len(payload) // 4
+		payload = payload[:runs * 4].tobytes()
+		counts = payload[0::4]
+
+		colors = bytearray(payload)
+		del colors[0::4]
+
+		return self.repeat(counts, colors)
+
+	@staticmethod
+	def repeat(counts: bytes, colors: bytearray) -> bytearray:
+		"""Repeat each packed RGB color of `colors` by its count, stepping only over the counts other than 1."""
+		if (counts.count(1) == len(counts)):
+			return colors
+
+		colors = memoryview(colors)
+		pixels = bytearray()
+		start = 0
+		for run in RUN.finditer(counts.translate(REPEAT)):
+			i = run.start()
+			pixels += colors[start * 3:i * 3]
+			pixels += colors[i * 3:i * 3 + 3].tobytes() * counts[i]
+			start = i + 1
+		pixels += colors[start * 3:]
 
 		return pixels
 	
-	def v3(self, bytes: bytes) -> list[Pixel]:
+	def v3(self, bytes: bytes) -> bytearray:
 		"""version 3.0 of the ULBMP format
 		
 		00000000  55 4c 42 4d 50 | 03 | 0e 00 | 00 01 | 03 00 | 18 | 00 | ff 00  |ULBMP...........|
@@ -219,48 +768,49 @@ class Decoder1: # TODO : static methode
 					
 		00000010  00 fe 00 00 fd 00 00 fc  00 00 fb 00 00 fa 00 00  |................|
 		"""
-		pixels = []
+		if (self.depth > 8):
+			# same layout as v1 / v2 (RLE)
+			return self.v2(bytes) if (self.compression) else self.v1(bytes)
+
+		payload = memoryview(bytes)[self.header_len:self.end].tobytes()
 
 		if self.depth == 8 and self.compression:
-			# Run-Length Encoding with 8bpp
-			i = self.header_len
-			while i < len(bytes):
-				# Get the run length and the pixel color index
-				run_length = bytes[i]
-				pixel_index = bytes[i + 1]
-
-				# Append the pixel color to the pixels list run_length times
-				pixel = self.palette[pixel_index]
-				pixels.extend([pixel] * run_length)
-
-				# Move to the next run
-				i += 2
-		elif (self.depth <= 8):
-			pixels_per_byte = 8 // self.depth
-			total_pixels = self.width * self.height
+			# Run-Length Encoding with 8bpp: (run length, pixel color index)
+			runs = len(payload) // 2
+			pixels = self.repeat(payload[0:runs * 2:2], self.palette_colors(payload[1:runs * 2:2]))
+		else:
+			indices = self.unpack_bits(payload, self.depth)
+			del indices[self.width * self.height:] # padding bits of the last byte
+			pixels = self.palette_colors(indices)
+		return pixels
 
-			for i in range(self.header_len, len(bytes)):
-				byte = bytes[i]
+	@staticmethod
+	def unpack_bits(payload: bytes, depth: int) -> bytearray:
+		"""Palette indices of `depth` bits packed in `payload`, 8 // depth per byte, first pixel in the high bits.
 
-				for j in range(pixels_per_byte - 1, -1, -1):
-					if len(pixels) >= total_pixels:
-						break
+		Pixel j of every byte is shifted and masked out of the whole payload in one `translate`.
+		"""
+		pixels_per_byte = 8 // depth
+		if (pixels_per_byte == 1):
+			return bytearray(payload)
 
-					pixel_index = (byte >> (j * self.depth)) & ((1 << self.depth) - 1)
-					pixel = self.palette[pixel_index]
-					pixels.append(pixel)
-		else:
-			bytes_per_pixel = self.depth // 8  # Number of bytes per pixel
+		mask = (1 << depth) - 1
+		indices = bytearray(len(payload) * pixels_per_byte)
+		for j in range(pixels_per_byte):
+			shift = (pixels_per_byte - 1 - j) * depth
+			indices[j::pixels_per_byte] = payload.translate(bytes((i >> shift) & mask for i in range(256)))
+		return indices
 
-			if (self.compression):
-				bytes_per_pixel += 1
+	def palette_colors(self, indices: bytes) -> bytearray:
+		"""Packed RGB of the palette `indices`, one `translate` per channel."""
+		if (indices and max(indices) >= len(self.palette_bytes) // 3):
+			raise Exception('Invalid palette index')
 
-			for i in range(self.header_len, len(bytes), bytes_per_pixel):
-				if (self.depth == 24 and self.compression): # RLE
-					for j in range(bytes[i]):
-						pixels.append(Pixel(bytes[i+1], bytes[i+2], bytes[i+3]))
-				else:
-					pixels.append(Pixel(bytes[i], bytes[i+1], bytes[i+2]))
+		palette = self.palette_bytes.ljust(256 * 3, b'\x00')
+		pixels = bytearray(len(indices) * 3)
+		pixels[0::3] = indices.translate(palette[0::3])
+		pixels[1::3] = indices.translate(palette[1::3])
+		pixels[2::3] = indices.translate(palette[2::3])
 		return pixels
 	
 	"""
@@ -279,96 +829,172 @@ class Decoder1: # TODO : static methode
 
 
 	"""
-	def v4(self, bytes: bytes) -> list[Pixel]:
+	def v4(self, bytes: bytes) -> bytearray:
 		"""version 4.0 of the ULBMP format usign QOL approach"""
-		pixels = []
+		if (self.chunk_rows):
+			return bytearray().join(self.chunks(bytes, self.chunk_rows * self.width))
+
+		chunks = self.v4_chunks(bytes, self.width * self.height)
+		pixels = next(chunks)
+		for chunk in chunks: # more pixels than width * height
+			pixels += chunk
+		return pixels
+
+	def v4_chunks(self, bytes: bytes, size: int=1 << 16, start: int=None, end: int=None) -> Iterator[bytearray]:
+		"""version 4.0 of the ULBMP format, decoded in chunks of `size` pixels (payload from `start` to `end`)
+
+		The running pixel is kept as three ints and each chunk is a preallocated buffer,
+		the deltas of the small and intermediate blocks come from SMALL_DIFF / INTERMEDIATE_DIFF.
+		With the CACHED flag, the colors seen are kept in a cache for the INDEX blocks (unless
+		the payload has none, with RUNS_ONLY).
+		"""
+		size *= 3
+		end = self.end if (end is None) else end
 		#P’ = Pixel noir = (0, 0, 0)
-		oldPixel = Pixel(0, 0, 0)
-		i = self.header_len
-		while i < len(bytes):
-			# read a byte
-			byte = bytes[i]
-			# get the type
-			if (byte == 0b11111111 == 0b11111111): # OK
-				# ULBMP_NEW_PIXEL
-				# read 3 bytes
-				oldPixel = Pixel(bytes[i+1], bytes[i+2], bytes[i+3])
-				pixels.append(oldPixel)
+		r, g, b = 0, 0, 0
+		i = self.header_len if (start is None) else start
+		cached = self.cached
+		indexed = self.cached and not self.runs_only
+		cache = [0] * CACHE_SIZE
+		left = 0 # repeats of a RUN block that did not fit in the previous chunk
 
-				i += 3
-			elif (byte & 0b11000000 == 0b00000000): # OK
-				# ULBMP_SMALL_DIFF
-				# 2 bits r, 2 bits g, 2 bits b
-				Dr = ((byte & 0b00110000) >> 4) -2
-				Dg = ((byte & 0b00001100) >> 2) -2
-				Db = ((byte & 0b00000011)) -2
-				# get the new pixel
-				# print("Small " , oldPixel.red + Dr, oldPixel.green + Dg, oldPixel.blue + Db)
-				newPixel = Pixel(oldPixel.red + Dr, oldPixel.green + Dg, oldPixel.blue + Db)
-				# append the new pixel
-				pixels.append(newPixel)
-				# update the old pixel
-				oldPixel = newPixel
-
-				# i += 1
-			elif (byte & 0b11000000 == 0b01000000): # OK
-				# print("ULBMP_INTERMEDIATE_DIFF")
-				# ULBMP_INTERMEDIATE_DIFF
-				# 2 bits type, 6 bits diff, 4 bits 
-				Dg = (byte & 0b00111111) - 32
-				Drg = ((bytes[i+1] & 0b11110000) >> 4) - 8
-				Dbg = (bytes[i+1] & 0b00001111) - 8
-				# get delta
-				Dr = Drg + Dg
-				Db = Dbg + Dg
-				# get the new pixel
-				# print("IT " , oldPixel.red + Dr, oldPixel.green + Dg, oldPixel.blue + Db)
-				newPixel = Pixel(oldPixel.red + Dr, oldPixel.green + Dg, oldPixel.blue + Db)
-				# append the new pixel
-				pixels.append(newPixel)
-				# update the old pixel
-				oldPixel = newPixel
-
-				i += 1
-			elif (byte & 0b10000000 == 0b10000000): # ok
-				# print("ULBMP_BIG_DIFF")
-				# ULBMP_BIG_DIFF
-				big_diff = (((byte & 0b00001111) << 4) | ((bytes[i+1] & 0b11110000) >> 4)) - 128
-				D1 = (((bytes[i+1] & 0b00001111) << 2) | ((bytes[i+2] & 0b11000000) >> 6)) - 32
-				D2 = ((bytes[i+2] & 0b00111111)) - 32
-
-				if (byte & 0b11110000 == 0b10100000):
-					# blue
-					Dr = D1 + big_diff
-					Dg = D2 + big_diff
-					Db = big_diff
-				elif (byte & 0b11110000 == 0b10010000):
-					# green
-					Dr = D1 + big_diff
-					Db = D2 + big_diff
-					Dg = big_diff
+		while True:
+			pixels = bytearray(size)
+			o = 0
+			try:
+				while o < size and (i < end or left):
+					if (left):
+						run = min(left, (size - o) // 3)
+						pixels[o:o + run * 3] = bytearray((r, g, b)) * run
+						o += run * 3
+						left -= run
+						continue
+					byte = bytes[i]
+					if (byte == 0b00101010 and i + 1 < end and bytes[i+1] == 0b00101010):
+						# ULBMP_SMALL_DIFF of (0, 0, 0) twice or more: the whole run repeats the pixel
+						run = min(len(SAME.match(bytes, i, end).group()), (size - o) // 3)
+						pixels[o:o + run * 3] = bytearray((r, g, b)) * run
+						o += run * 3
+						i += run
+						continue
+					elif (byte < 0b01000000):
+						# ULBMP_SMALL_DIFF: 2 bits r, 2 bits g, 2 bits b
+						Dr, Dg, Db = SMALL_DIFF[byte]
+						r += Dr
+						g += Dg
+						b += Db
+						i += 1
+					elif (byte < 0b10000000):
+						# ULBMP_INTERMEDIATE_DIFF: 6 bits green, 4 bits red - green, 4 bits blue - green
+						Dg = byte - 0b01000000 - 32
+						Drg, Dbg = INTERMEDIATE_DIFF[bytes[i+1]]
+						r += Drg + Dg
+						g += Dg
+						b += Dbg + Dg
+						i += 2
+					elif (byte == 0b11111111):
+						# ULBMP_NEW_PIXEL
+						r, g, b = bytes[i+1], bytes[i+2], bytes[i+3]
+						i += 4
+					elif (cached and byte >= 0b11000000):
+						# ULBMP_INDEX: 6 bits index in the cache of colors
+						color = cache[byte & 0b00111111]
+						r, g, b = color >> 16, color >> 8 & 0b11111111, color & 0b11111111
+						i += 1
+					elif (cached and byte >= 0b10110000):
+						# ULBMP_RUN: 12 bits number of repeats of the previous pixel - 1
+						left = ((byte & 0b00001111) << 8 | bytes[i+1]) + 1
+						i += 2
+						continue
+					else:
+						# ULBMP_BIG_DIFF: 4 bits type, 8 bits main channel, 2 * 6 bits other channels - main
+						byte1, byte2 = bytes[i+1], bytes[i+2]
+						big_diff = ((byte & 0b00001111) << 4 | byte1 >> 4) - 128
+						D1 = ((byte1 & 0b00001111) << 2 | byte2 >> 6) - 32 + big_diff
+						D2 = (byte2 & 0b00111111) - 32 + big_diff
+
+						if (byte & 0b11110000 == 0b10100000):
+							# blue
+							r += D1
+							g += D2
+							b += big_diff
+						elif (byte & 0b11110000 == 0b10010000):
+							# green
+							r += D1
+							g += big_diff
+							b += D2
+						else:
+							# red
+							r += big_diff
+							g += D1
+							b += D2
+						i += 3
+					pixels[o] = r
+					pixels[o+1] = g
+					pixels[o+2] = b
+					o += 3
+					if (indexed):
+						cache[(r * 3 + g * 5 + b * 7) % CACHE_SIZE] = r << 16 | g << 8 | b
+			except ValueError:
+				raise Exception('Invalid color value')
+			except IndexError: # a block cut short at the end of the file
+				raise Exception('Invalid number of pixels')
+			if (i > end): # a block cut short at the end of the payload or of its chunk
+				raise Exception('Invalid number of pixels')
+
+			if (i >= end and not left):
+				del pixels[o:]
+				yield pixels
+				return
+			yield pixels
+
+	def chunks(self, bytes: bytes, size: int=1 << 16, first: int=0) -> Iterator[bytearray]:
+		"""Decode a sequential payload (RLE or v4) block by block of `size` records, as packed RGB.
+
+		A payload split in chunks of rows is decoded from its chunk `first`, one chunk after the other.
+		"""
+		if (self.chunk_rows):
+			for k in range(first, len(self.offsets) - 1):
+				start, end = self.header_len + self.offsets[k], self.header_len + self.offsets[k + 1]
+				rows = min(self.chunk_rows, self.height - k * self.chunk_rows)
+				decoded = 0
+
+				if (self.version == 2):
+					blocks = (self.runs(memoryview(bytes)[i:min(end, i + size * 4)]) for i in range(start, end, size * 4))
 				else:
-					# red
-					Dg = D1 + big_diff
-					Db = D2 + big_diff
-					Dr = big_diff
-				# get the new pixel
-				newPixel = Pixel(oldPixel.red + Dr, oldPixel.green + Dg, oldPixel.blue + Db)
-				# append the new pixel
-				pixels.append(newPixel)
-				# update the old pixel
-				oldPixel = newPixel
-
-				i += 2
-			# else :
-			# 	print(f'Unsupported version 4.0 byte {bin(byte)}')
-			i += 1
-		# print(pixels)
-		return pixels
+					blocks = self.v4_chunks(bytes, size, start, end)
+				for pixels in blocks:
+					decoded += len(pixels)
+					yield pixels
+				if (decoded != rows * self.width * 3):
+					raise Exception('Invalid number of pixels')
+			return
+
+		payload = memoryview(bytes)[self.header_len:self.end]
+
+		if (self.version == 2 or (self.version == 3 and self.depth > 8)):
+			for i in range(0, len(payload), size * 4):
+				yield self.runs(payload[i:i + size * 4])
+		elif (self.version == 3):
+			# Run-Length Encoding with 8bpp: (run length, pixel color index)
+			for i in range(0, len(payload) - 1, size * 2):
+				block = payload[i:i + size * 2].tobytes()
+				runs = len(block) // 2
+				yield self.repeat(block[0:runs * 2:2], self.palette_colors(block[1:runs * 2:2]))
+		elif (self.version == 4):
+			yield from self.v4_chunks(bytes, size)
+		else:
+			raise Exception(f'Unsupported version {self.version}')
 
-	def read_pixels(self, bytes: bytes) -> list[Pixel]:
-		"""Read the pixels from the file."""
-		pixels = []
+	def fixed_stride(self) -> bool:
+		"""Whether a row can be found without decoding the ones before it (v1, v3 without RLE)."""
+		return self.version == 1 or (self.version == 3 and not (self.compression and self.depth >= 8))
+
+	def read_pixels(self, bytes: bytes) -> bytearray:
+		"""Read the pixels from the file as a packed RGB buffer (after its checksums, if it has any)."""
+		pixels = None
+		if (self.checksum):
+			self.check_sums(bytes)
 
 		match self.version:
 			case 1:
@@ -381,13 +1007,28 @@ class Decoder1: # TODO : static methode
 				pixels = self.v4(bytes)
 			case _:
 				raise Exception(f'Unsupported version {self.version}')
+		if (len(pixels) != self.width * self.height * 3):
+			raise Exception('Invalid number of pixels')
 		return pixels
 
-	def read_header(self, bytes: bytes) -> None:
+	def check_sums(self, bytes: bytes) -> None:
+		"""Compare the CRC32 of each block of the payload with the checksums after it."""
+		view = memoryview(bytes)
+		try:
+			sums = Checksums(view[self.header_len:self.end]).trailer()
+			if (sums != view[self.end:]):
+				blocks = (k for k in range(0, len(sums), 4) if (sums[k:k + 4] != view[self.end + k:self.end + k + 4]))
+				raise Exception(f'Invalid checksum of the block {next(blocks, len(sums)) // 4} of the payload')
+		finally:
+			view.release()
+
+	def read_header(self, bytes: bytes, size: int=None) -> None:
+		"""Read the header at the start of `bytes`, `size` is the size of the file when `bytes` is only its start."""
 		self.depth = 0
 		self.compression = 0
 		self.palette = None
-		data_size = len(bytes)
+		self.palette_bytes = b''
+		data_size = len(bytes) if (size is None) else size
 
 		if (data_size < 12): # Format + Version + Header size + width + height | 15 for 1 pixel ?
 			raise Exception('Invalid file format')
@@ -400,32 +1041,68 @@ class Decoder1: # TODO : static methode
 		self.header_len = int.from_bytes(bytes[6:8], byteorder='little')
 		self.width = int.from_bytes(bytes[8:10], byteorder='little')
 		self.height = int.from_bytes(bytes[10:12], byteorder='little')
+		self.chunk_rows = 0
+		self.offsets = None
+		self.cached = False
+		self.runs_only = False
+		self.checksum = False
 		
 		if (self.width <= 0 or self.height <= 0):
 			raise Exception('Invalid dimensions')
+		if (self.header_len < 12 or data_size < self.header_len):
+			raise Exception('Invalid header size')
+
+		if (self.version & CHECKSUM):
+			# the payload is followed by its checksums
+			self.version &= ~CHECKSUM
+			self.checksum = True
+			data_size -= Checksums.trailer_len(data_size - self.header_len)
+		self.end = data_size # end of the payload
+
+		if (self.version & CACHED and self.version & ~(CACHED | CHUNKED | RUNS_ONLY) == 4):
+			# v4 payload using the RUN and INDEX blocks, or only the RUN blocks
+			self.runs_only = bool(self.version & RUNS_ONLY)
+			self.version &= ~(CACHED | RUNS_ONLY)
+			self.cached = True
+
+		if (self.version & CHUNKED and self.version & ~CHUNKED in (2, 4)):
+			# payload split in chunks of rows: rows per chunk, then the offset of each chunk
+			self.version &= ~CHUNKED
+			self.chunk_rows = int.from_bytes(bytes[12:14], byteorder='little')
+			if (self.chunk_rows == 0 or self.header_len != 14 + 4 * -(-self.height // self.chunk_rows) or data_size < self.header_len):
+				raise Exception('Invalid header size')
+
+			self.offsets = [int.from_bytes(bytes[i:i+4], byteorder='little') for i in range(14, self.header_len, 4)]
+			self.offsets.append(data_size - self.header_len)
+			if (self.offsets[0] != 0 or any(a > b for a, b in zip(self.offsets, self.offsets[1:]))):
+				raise Exception('Invalid chunk offset')
 		
-		match self.version: # TODO : remake checker
-			case 1:
-				if (self.header_len < 12):
-					raise Exception('Invalid header size')
-			case 2:
-				if (self.header_len < 12):
-					raise Exception('Invalid header size')
+		match self.version:
+			case 1 | 2 | 4:
+				pass
 			case 3:
-				if (self.header_len < 12):
+				if (self.header_len < 14 or (self.header_len - 14) % 3):
 					raise Exception('Invalid header size')
 				self.depth = bytes[12]
 				self.compression = bytes[13]
 				self.palette = []
 				for i in range(14, self.header_len, 3):
-					self.palette.append(Pixel(bytes[i], bytes[i+1], bytes[i+2]))
+					self.palette.append(Pixel.from_rgb(bytes[i], bytes[i+1], bytes[i+2]))
+				self.palette_bytes = memoryview(bytes)[14:self.header_len].tobytes() # packed RGB of the palette
 				# print(self.depth, self.compression, self.palette)
-			case 4:
-				if (self.header_len < 12):
-					raise Exception('Invalid header size')
+				if (self.depth not in (1, 2, 4, 8, 24) or self.compression not in (0, 1)):
+					raise Exception('Invalid depth or compression')
+				if (self.depth <= 8 and not 0 < len(self.palette) <= 1 << self.depth):
+					raise Exception('Invalid number of colors')
 			case _:
 				raise Exception(f'Unsupported version {self.version}') 
-		# TODO : check valid values
+
+		# payloads of a fixed size, the packed palette indices can have a few bytes more
+		payload = self.end - self.header_len
+		if (self.fixed_stride()):
+			expected = self.width * self.height * 3 if (self.version == 1 or self.depth > 8) else -(-self.width * self.height // (8 // self.depth))
+			if (payload < expected or (payload != expected and (self.version == 1 or self.depth > 8))):
+				raise Exception('Invalid number of pixels')
 
 
 	def __repr__(self) -> str: # not asked
@@ -433,3 +1110,255 @@ class Decoder1: # TODO : static methode
 {PINK}- width: {MB}{self.width}\n {PINK}- height: {MB}{self.height}\n \
 {PINK}- depth: {MB}{self.depth}\n {PINK}- compression: {MB}{self.compression}\n{C}{self.palette}\n"
 
+class Reader(Decoder1):
+	"""Lazy access to the rows of an image in the ULBMP format, the file is mapped in memory
+	(the content of a file given as bytes, or read from a file object, is used as is).
+
+	Fixed stride payloads (v1, v3 without RLE) are addressed directly, RLE and v4 payloads
+	are decoded sequentially and only up to the last row asked for.
+	"""
+	def __init__(self, path: str | bytes | BinaryIO):
+		path = read_source(path)
+		self.path = path if (isinstance(path, (str, os.PathLike))) else None # decoded in memory otherwise
+		if (self.path is None):
+			if (not path):
+				raise Exception('Invalid file format')
+			self.map = path
+		else:
+			with open(path, 'rb') as file:
+				if (not file.seek(0, 2)):
+					raise Exception('Invalid file format')
+				self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		self.read_header(self.map)
+		self.row_len = self.width * 3
+		# state of the sequential decoding, rows from self.y are held in self.pending
+		self.stream = None
+		self.pending = bytearray()
+		self.y = 0
+
+	def rows(self, y0: int, y1: int) -> memoryview | bytearray:
+		"""Packed RGB of the rows `y0` to `y1` (excluded).
+
+		For v1 and v3 with depth 24 this is a view on the file: it must be released before `close`.
+		"""
+		if y0 < 0 or y1 > self.height or y0 > y1:
+			raise IndexError('Index out of range')
+
+		if (self.fixed_stride() and (self.version == 1 or self.depth > 8)):
+			start = self.header_len + y0 * self.row_len
+			view = memoryview(self.map)[start:start + (y1 - y0) * self.row_len]
+			if (len(view) != (y1 - y0) * self.row_len):
+				raise Exception('Invalid number of pixels')
+			return view
+		if (self.fixed_stride()):
+			# the first pixel of a row can sit in the middle of a byte
+			pixels_per_byte = 8 // self.depth
+			first, last = y0 * self.width, y1 * self.width
+			start = self.header_len + first // pixels_per_byte
+			indices = self.unpack_bits(self.map[start:self.header_len - (-last // pixels_per_byte)], self.depth)
+			indices = indices[first % pixels_per_byte:first % pixels_per_byte + last - first]
+			if (len(indices) != last - first):
+				raise Exception('Invalid number of pixels')
+			return self.palette_colors(indices)
+
+		if (self.stream is None or y0 < self.y or
+			(self.chunk_rows and y0 - y0 % self.chunk_rows > self.y + len(self.pending) // self.row_len)):
+			# start over, from the chunk of y0 when the payload is split in chunks
+			first = y0 // self.chunk_rows if (self.chunk_rows) else 0
+			self.stream = self.chunks(self.map, first=first)
+			self.pending = bytearray()
+			self.y = first * self.chunk_rows
+
+		while True:
+			# drop the rows before y0 as soon as they are decoded
+			skip = min(y0 - self.y, len(self.pending) // self.row_len)
+			del self.pending[:skip * self.row_len]
+			self.y += skip
+			if (self.y == y0 and len(self.pending) >= (y1 - y0) * self.row_len):
+				return self.pending[:(y1 - y0) * self.row_len]
+
+			chunk = next(self.stream, None)
+			if (chunk is None):
+				raise Exception('Invalid number of pixels')
+			self.pending += chunk
+
+	def load(self, progress=None) -> Image:
+		"""Decode the whole image by bands of about 1 MB, `progress(rows decoded, rows)` is called after each one."""
+		pixels = bytearray(self.height * self.row_len)
+		step = max(1, (1 << 20) // self.row_len)
+
+		for y in range(0, self.height, step):
+			y1 = min(self.height, y + step)
+			rows = self.rows(y, y1)
+			pixels[y * self.row_len:y1 * self.row_len] = rows
+			if (isinstance(rows, memoryview)):
+				rows.release()
+			if (progress):
+				progress(y1, self.height)
+
+		# no pixels past the last row (the size of fixed stride payloads is checked by `read_header`)
+		if (self.checksum):
+			self.check_sums(self.map)
+		if (not self.fixed_stride() and (len(self.pending) > (self.height - self.y) * self.row_len or any(self.stream))):
+			raise Exception('Invalid number of pixels')
+		return Image(self.width, self.height, pixels)
+
+	def verify(self) -> None:
+		"""Check the whole payload without decoding its pixels.
+
+		The checksums are compared first, if the file has any. Then the records of each chunk
+		(of the whole payload) must add up to its pixels and the palette indices must be in the
+		palette. v4 colors that go out of range are only found by decoding.
+		"""
+		if (self.checksum):
+			self.check_sums(self.map)
+		if (self.fixed_stride() and self.version == 3 and self.depth <= 8 and len(self.palette) < 1 << self.depth):
+			# the size was checked by `read_header`, the pixels past the last one are padding
+			pixels = self.width * self.height
+			for first in range(0, pixels, CHECK_BLOCK):
+				self.check_indices(first, min(pixels, first + CHECK_BLOCK))
+		if (self.fixed_stride()):
+			return
+
+		if (self.chunk_rows):
+			chunks = [(self.header_len + self.offsets[k], self.header_len + self.offsets[k + 1],
+				min(self.chunk_rows, self.height - k * self.chunk_rows) * self.width) for k in range(len(self.offsets) - 1)]
+		else:
+			chunks = [(self.header_len, self.end, self.width * self.height)]
+		for start, end, pixels in chunks:
+			if (self.count_pixels(start, end) != pixels):
+				raise Exception('Invalid number of pixels')
+
+	def check_indices(self, first: int, last: int) -> None:
+		"""Check that the packed palette indices of the pixels `first` to `last` are in the palette."""
+		pixels_per_byte = 8 // self.depth
+		start = self.header_len + first // pixels_per_byte
+		indices = self.unpack_bits(self.map[start:self.header_len - (-last // pixels_per_byte)], self.depth)
+		if (max(indices[first % pixels_per_byte:first % pixels_per_byte + last - first]) >= len(self.palette)):
+			raise Exception('Invalid palette index')
+
+	def count_pixels(self, start: int, end: int) -> int:
+		"""Pixels of the RLE or v4 records from `start` to `end` of the file, read CHECK_BLOCK bytes at a time."""
+		count = 0
+		if (self.version == 4):
+			blocks, stream = (CACHED_BLOCKS, CACHED_STREAM) if (self.cached) else (BLOCKS, STREAM)
+			while start < end:
+				# the whole blocks of the window, one cut at its end is left to the next window
+				stop = stream.match(self.map, start, min(end, start + max(CHECK_BLOCK, 4))).end()
+				if (stop == start):
+					raise Exception('Invalid block')
+				window = self.map[start:stop]
+				count += blocks.subn(b'', window)[1]
+				if (self.cached):
+					# a RUN block stands for 1 to 4096 pixels
+					runs = b''.join(RUNS.findall(window))
+					count += sum(runs[1::2]) + (sum(runs[0::2]) - 0b10110000 * (len(runs) // 2)) * 256
+				start = stop
+			return count
+
+		record = 2 if (self.version == 3 and self.depth == 8) else 4
+		if ((end - start) % record):
+			raise Exception('Invalid number of pixels')
+		size = max(record, CHECK_BLOCK - CHECK_BLOCK % record) # whole records
+		for i in range(start, end, size):
+			window = self.map[i:min(end, i + size)]
+			if (record == 2 and len(self.palette) < 256 and max(window[1::2]) >= len(self.palette)):
+				raise Exception('Invalid palette index')
+			count += sum(window[::record])
+		return count
+
+	def load_bands(self, workers: int) -> Image:
+		"""Decode the whole image by bands of rows in `workers` processes, into shared memory.
+
+		The checksums, if the file has any, are compared while the workers decode.
+		"""
+		step = self.chunk_rows or 1 # bands start on a chunk
+		bands = [self.height * k // workers // step * step for k in range(workers)] + [self.height]
+		size = self.height * self.row_len
+
+		shm = SharedMemory(create=True, size=size)
+		try:
+			with ProcessPoolExecutor(workers) as pool:
+				done = pool.map(decode_band, repeat(self.path), repeat(shm.name), bands[:-1], bands[1:])
+				if (self.checksum):
+					self.check_sums(self.map)
+				for _ in done:
+					pass
+			pixels = bytearray(shm.buf[:size])
+		finally:
+			shm.close()
+			shm.unlink()
+		return Image(self.width, self.height, pixels)
+
+	def tile(self, x: int, y: int, width: int, height: int) -> bytearray:
+		"""Packed RGB of the `width` x `height` tile at (`x`, `y`)."""
+		if x < 0 or width < 0 or x + width > self.width:
+			raise IndexError('Index out of range')
+
+		rows = self.rows(y, y + height)
+		tile = bytearray().join(rows[i:i + width * 3] for i in range(x * 3, len(rows), self.row_len))
+		if (isinstance(rows, memoryview)):
+			rows.release()
+		return tile
+
+	def load_region(self, region: tuple[int, int, int, int]=None, scale: float=1, progress=None) -> Image:
+		"""Image of the part (x, y, width, height) of the image, shrunk by averaging blocks of k x k pixels for a `scale` of 1 / k.
+
+		Rows are read one band of k rows at a time: v1 and v3 without RLE only read the rows of
+		the region, RLE and v4 payloads are decoded up to its last row and the rows before it are
+		dropped as they come. Memory is the size of the output and one band.
+		"""
+		x, y, width, height = region or (0, 0, self.width, self.height)
+		if x < 0 or y < 0 or width <= 0 or height <= 0 or x + width > self.width or y + height > self.height:
+			raise IndexError('Index out of range')
+		k = round(1 / scale)
+		if (k < 1 or abs(k * scale - 1) > 1e-9):
+			raise Exception('Invalid scale, 1 / k expected')
+
+		pixels = bytearray()
+		for y0 in range(y, y + height, k):
+			y1 = min(y + height, y0 + k)
+			band = self.tile(x, y0, width, y1 - y0)
+			pixels += band if (k == 1) else self.shrink(band, width, y1 - y0, k)
+			if (progress):
+				progress(y1 - y, height)
+		return Image(-(-width // k), -(-height // k), pixels)
+
+	@staticmethod
+	def shrink(band: bytearray, width: int, rows: int, k: int) -> bytes:
+		"""One row of packed RGB averaging the blocks of k columns of a band of `rows` rows of `width` pixels.
+
+		The rows are added up as big integers with each byte in its own 32 bits lane, then the
+		samples at the same place of every block are added, the last block can be narrower.
+		"""
+		columns = -(-width // k)
+		row_len = width * 3
+		lanes = bytearray(row_len * 4)
+		low = 0 if (sys.byteorder == 'little') else 3
+		total = 0
+		for r in range(rows):
+			lanes[low::4] = band[r * row_len:(r + 1) * row_len]
+			total += int.from_bytes(lanes, sys.byteorder)
+		sums = memoryview(total.to_bytes(row_len * 4, sys.byteorder)).cast('I').tolist()
+		sums += [0] * ((columns * k - width) * 3)
+
+		counts = [rows * k] * (columns - 1) + [rows * (width - (columns - 1) * k)]
+		out = bytearray(columns * 3)
+		for c in range(3):
+			totals = sums[c::k * 3]
+			for dx in range(1, k):
+				totals = list(map(add, totals, sums[dx * 3 + c::k * 3]))
+			out[c::3] = bytes((total + count // 2) // count for total, count in zip(totals, counts))
+		return out
+
+	def close(self) -> None:
+		self.stream = None
+		if (isinstance(self.map, mmap.mmap)):
+			self.map.close()
+
+	def __enter__(self) -> 'Reader':
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.close()
@@ -0,0 +1,255 @@
+"""Sequences of frames of the same size in one file, each frame stored as its change from the previous one.
+
+File layout (little endian):
+	b"ULBMF", version (1 byte), width, height, tile side (2 bytes each), frames (4 bytes),
+	offset of the index (8 bytes), then the frames, then the index: for each frame its offset
+	in the file (8 bytes) and its kind (1 byte).
+
+A key frame is a ULBMP image. A delta frame is a bitmap of the tiles that changed (one bit per
+tile, row by row, low bit first), then the changed tiles XORed with the previous frame, stacked
+in tall ULBMP images of `tile` pixels wide (each after its size on 4 bytes). Unchanged pixels
+XOR to black, which v4 stores as runs. An unchanged frame takes the bitmap only.
+"""
+import mmap
+from typing import Iterator
+
+from encoding import Decoder1, Encoder
+from image import Image
+
+MAGIC = b"ULBMF"
+VERSION = 1
+HEADER_LEN = 24
+KEY, DELTA = 0, 1 # kinds of frame
+
+def xor(a: bytes, b: bytes) -> bytes:
+	"""Bytes of `a` XOR `b`, of the same length."""
+	return (int.from_bytes(a) ^ int.from_bytes(b)).to_bytes(len(a))
+
+class FrameWriter:
+	"""Writes frames to a file one at a time, see the module docstring.
+
+	A key frame is written first, every `keyframe` frames (0 for never) and whenever more than
+	half of the tiles changed. Images are encoded as v4 with the compression `level`.
+	"""
+	def __init__(self, path: str, width: int, height: int, tile: int=64, keyframe: int=0, level: int=2):
+		if (not 0 < width < 1 << 16 or not 0 < height < 1 << 16):
+			raise Exception('Invalid dimensions')
+		if (not 0 < tile < 256):
+			raise Exception('Invalid tile size')
+
+		self.width = width
+		self.height = height
+		self.tile = tile
+		self.keyframe = keyframe
+		self.level = level
+		self.columns = -(-width // tile)
+		self.tiles = self.columns * -(-height // tile)
+		self.previous = None # packed RGB of the last frame
+		self.index = [] # (offset, kind) of each frame
+		self.file = open(path, 'wb')
+		self.file.write(bytes(HEADER_LEN))
+
+	def image(self, width: int, height: int, data: bytes) -> bytes:
+		"""ULBMP file of packed RGB pixels, in memory."""
+		return Encoder(Image(width, height, data), 4, level=self.level).to_bytes()
+
+	def add(self, frame: Image | bytes) -> None:
+		"""Write the next frame, an image or its packed RGB."""
+		data = bytes(frame.data if (isinstance(frame, Image)) else frame)
+		if (len(data) != self.width * self.height * 3):
+			raise Exception('Invalid frame size')
+
+		self.index.append((self.file.tell(), KEY))
+		changed = None if (self.previous is None) else self.changed_tiles(data)
+		if (changed is None or 2 * len(changed) > self.tiles or (self.keyframe and (len(self.index) - 1) % self.keyframe == 0)):
+			self.file.write(bytes([KEY]) + self.image(self.width, self.height, data))
+		else:
+			self.index[-1] = (self.index[-1][0], DELTA)
+			self.write_delta(data, changed)
+		self.previous = data
+
+	def changed_tiles(self, data: bytes) -> list[int]:
+		"""Tiles (row by row) with a pixel other than in the previous frame.
+
+		Whole rows are compared first, the tiles are only compared on rows that changed.
+		"""
+		tile, row_len = self.tile, self.width * 3
+		current, previous = memoryview(data), memoryview(self.previous)
+		changed = set()
+
+		for y in range(self.height):
+			start = y * row_len
+			if (current[start:start + row_len] == previous[start:start + row_len]):
+				continue
+			first = y // tile * self.columns
+			for tx in range(self.columns):
+				if (first + tx not in changed):
+					a, b = start + tx * tile * 3, start + min((tx + 1) * tile, self.width) * 3
+					if (current[a:b] != previous[a:b]):
+						changed.add(first + tx)
+		return sorted(changed)
+
+	def write_delta(self, data: bytes, changed: list[int]) -> None:
+		"""Write the bitmap of the `changed` tiles, then those tiles XORed with the previous frame."""
+		bitmap = bytearray(-(-self.tiles // 8))
+		for i in changed:
+			bitmap[i >> 3] |= 1 << (i & 7)
+		out = bytearray([DELTA]) + bitmap
+
+		tile, row_len = self.tile, self.width * 3
+		per_image = (1 << 16) // tile - 1 # tiles stacked in an image at most, for its 2 bytes height
+		for group in range(0, len(changed), per_image):
+			stack = bytearray()
+			for i in changed[group:group + per_image]:
+				x, y = i % self.columns * tile, i // self.columns * tile
+				width = min(tile, self.width - x)
+				for row in range(y, y + tile):
+					if (row < self.height):
+						a = row * row_len + x * 3
+						stack += xor(data[a:a + width * 3], self.previous[a:a + width * 3])
+						stack += bytes((tile - width) * 3)
+					else:
+						stack += bytes(tile * 3)
+			payload = self.image(tile, len(stack) // (tile * 3), stack)
+			out += len(payload).to_bytes(4, byteorder='little') + payload
+		self.file.write(out)
+
+	def close(self) -> None:
+		"""Write the index and the header, and close the file."""
+		try:
+			index_offset = self.file.tell()
+			self.file.write(b''.join(offset.to_bytes(8, byteorder='little') + bytes([kind]) for offset, kind in self.index))
+			self.file.seek(0)
+			header = MAGIC + bytes([VERSION])
+			for value in (self.width, self.height, self.tile):
+				header += value.to_bytes(2, byteorder='little')
+			header += len(self.index).to_bytes(4, byteorder='little') + index_offset.to_bytes(8, byteorder='little')
+			self.file.write(header)
+		finally:
+			self.file.close()
+
+	def __enter__(self) -> 'FrameWriter':
+		return self
+
+	def __exit__(self, type, value, traceback) -> None:
+		if (type is None):
+			self.close()
+		else:
+			self.file.close()
+
+class FrameReader:
+	"""Reads the frames of a file one at a time, only the frame being built is kept in memory.
+
+	The file is mapped in memory, the header and the index are read when it is opened.
+	"""
+	def __init__(self, path: str):
+		self.file = open(path, 'rb')
+		try:
+			self.stream = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError: # empty file
+			self.file.close()
+			raise Exception('Invalid file format')
+		header = self.stream[:HEADER_LEN]
+
+		if (len(header) < HEADER_LEN or header[:5] != MAGIC):
+			self.close()
+			raise Exception('Invalid file format')
+		if (header[5] != VERSION):
+			self.close()
+			raise Exception(f'Unsupported version {header[5]}')
+
+		self.width, self.height, self.tile = (int.from_bytes(header[i:i + 2], byteorder='little') for i in (6, 8, 10))
+		count = int.from_bytes(header[12:16], byteorder='little')
+		index_offset = int.from_bytes(header[16:24], byteorder='little')
+		if (self.width == 0 or self.height == 0 or self.tile == 0):
+			self.close()
+			raise Exception('Invalid dimensions')
+		if (index_offset < HEADER_LEN or index_offset + count * 9 != len(self.stream)):
+			self.close()
+			raise Exception('Invalid frame index')
+
+		self.columns = -(-self.width // self.tile)
+		self.tiles = self.columns * -(-self.height // self.tile)
+		index = self.stream[index_offset:]
+		self.offsets = [int.from_bytes(index[i:i + 8], byteorder='little') for i in range(0, len(index), 9)] + [index_offset]
+		self.kinds = index[8::9]
+		if (count and self.kinds[0] != KEY or any(a > b for a, b in zip(self.offsets, self.offsets[1:]))):
+			self.close()
+			raise Exception('Invalid frame index')
+
+	def __len__(self) -> int:
+		return len(self.kinds)
+
+	def image(self, payload: bytes) -> bytearray:
+		"""Packed RGB of an image stored in a frame."""
+		decoder = Decoder1()
+		decoder.read_header(payload)
+		return decoder.read_pixels(payload)
+
+	def frames(self, start: int=0) -> Iterator[Image]:
+		"""Frames from `start` to the last one, decoded from the key frame before `start`."""
+		if (not 0 <= start <= len(self)):
+			raise Exception('Invalid frame number')
+		key = max((i for i in range(start + 1) if (i < len(self) and self.kinds[i] == KEY)), default=0)
+		current = None
+
+		for i in range(key, len(self)):
+			record = self.stream[self.offsets[i]:self.offsets[i + 1]]
+			if (record[:1] == bytes([KEY])):
+				current = self.image(record[1:])
+			elif (record[:1] == bytes([DELTA]) and current is not None):
+				self.apply_delta(current, record[1:])
+			else:
+				raise Exception('Invalid frame')
+			if (len(current) != self.width * self.height * 3):
+				raise Exception('Invalid number of pixels')
+			if (i >= start):
+				yield Image(self.width, self.height, bytearray(current))
+
+	def frame(self, i: int) -> Image:
+		"""The frame `i`."""
+		if (not 0 <= i < len(self)):
+			raise Exception('Invalid frame number')
+		return next(self.frames(i))
+
+	def apply_delta(self, current: bytearray, record: bytes) -> None:
+		"""XOR the changed tiles of a delta frame into the previous frame."""
+		tile, row_len = self.tile, self.width * 3
+		bitmap_len = -(-self.tiles // 8)
+		bitmap = record[:bitmap_len]
+		changed = [i for i in range(self.tiles) if (bitmap[i >> 3] >> (i & 7) & 1)]
+		pos = bitmap_len
+
+		per_image = (1 << 16) // tile - 1
+		for group in range(0, len(changed), per_image):
+			size = int.from_bytes(record[pos:pos + 4], byteorder='little')
+			stack = self.image(record[pos + 4:pos + 4 + size])
+			pos += 4 + size
+			tiles = changed[group:group + per_image]
+			if (len(stack) != len(tiles) * tile * tile * 3):
+				raise Exception('Invalid number of pixels')
+
+			for k, i in enumerate(tiles):
+				x, y = i % self.columns * tile, i // self.columns * tile
+				width = min(tile, self.width - x) * 3
+				for row in range(y, min(y + tile, self.height)):
+					a = row * row_len + x * 3
+					b = ((k * tile) + row - y) * tile * 3
+					current[a:a + width] = xor(current[a:a + width], stack[b:b + width])
+		if (pos != len(record)):
+			raise Exception('Invalid frame')
+
+	def __iter__(self) -> Iterator[Image]:
+		return self.frames()
+
+	def close(self) -> None:
+		if (self.stream is not None):
+			self.stream.close()
+		self.stream = None
+		self.file.close()
+
+	def __enter__(self) -> 'FrameReader':
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.close()
@@ -1,45 +1,154 @@
+import sys
+from collections.abc import Sequence
 
 from pixel import Pixel
+from stats import ImageStats
+
+class PixelView(Sequence):
+	"""Read-only sequence of the pixels of an image, each `Pixel` built when it is asked for (see `Pixel.from_rgb`).
+
+	It follows the image: pixels set after it was taken are seen.
+	"""
+	__slots__ = ('image',)
+
+	def __init__(self, image: 'Image'):
+		self.image = image
+
+	def __len__(self) -> int:
+		return len(self.image.data) // 3
+
+	def __getitem__(self, i: int | slice) -> Pixel | list[Pixel]:
+		if isinstance(i, slice):
+			return [self[k] for k in range(*i.indices(len(self)))]
+		if i < 0:
+			i += len(self)
+		if i < 0 or i >= len(self):
+			raise IndexError('Index out of range')
+		data = self.image.data
+		return Pixel.from_rgb(data[3 * i], data[3 * i + 1], data[3 * i + 2])
+
+	def __iter__(self):
+		data = self.image.data
+		return map(Pixel.from_rgb, data[0::3], data[1::3], data[2::3])
+
+	def __eq__(self, other) -> bool:
+		if isinstance(other, PixelView):
+			return self.image.data == other.image.data
+		if not isinstance(other, Sequence) or isinstance(other, (str, bytes, bytearray)):
+			return NotImplemented
+		return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+	__hash__ = None
+
+	def __repr__(self) -> str: # not asked
+		return repr(list(self))
 
 class Image:
 	"""
 	Represents an image with a given width, height, and pixel values.
+	Pixels are stored packed in `data` as RGB triplets (3 bytes per pixel, row-major),
+	`Pixel` objects are only created when one is asked for.
+	`stats` must be reset to None by code writing to `data` directly.
 	"""
-	def __init__(self, width: int, height: int, pixels: list[Pixel]):
+	def __init__(self, width: int, height: int, pixels: list[Pixel] | bytes | bytearray | memoryview):
 		if width <= 0 or height <= 0:
 			raise Exception('Invalid dimensions')
-		if len(pixels) != width * height:
-			raise Exception('Invalid number of pixels')
-		if (not all(isinstance(p, Pixel) for p in pixels)):
-			raise Exception('Invalid pixel type')
-		
+
+		if isinstance(pixels, PixelView):
+			pixels = memoryview(pixels.image.data) # copied, not shared with the other image
+		if isinstance(pixels, (bytes, bytearray, memoryview)):
+			if len(pixels) != width * height * 3:
+				raise Exception('Invalid number of pixels')
+			# a bytearray is adopted as is, anything else is copied once
+			data = pixels if isinstance(pixels, bytearray) else bytearray(pixels)
+		else:
+			if len(pixels) != width * height:
+				raise Exception('Invalid number of pixels')
+			data = self.pack(pixels)
+
 		self.width = width
 		self.height = height
-		self.pixels = pixels
+		self.data = data
+		self._stats = None
+
+	@staticmethod
+	def pack(pixels: list[Pixel]) -> bytearray:
+		"""Pack a list of pixels into an RGB bytearray."""
+		if (not all(isinstance(p, Pixel) for p in pixels)):
+			raise Exception('Invalid pixel type')
+
+		data = bytearray(len(pixels) * 3)
+		data[0::3] = bytes(p.red for p in pixels)
+		data[1::3] = bytes(p.green for p in pixels)
+		data[2::3] = bytes(p.blue for p in pixels)
+		return data
+
+	def packed(self) -> memoryview:
+		"""Pixels as one integer each, `red << 16 | green << 8 | blue`, for bulk lookups and comparisons."""
+		return self.pack_ints(self.data)
+
+	@staticmethod
+	def pack_ints(data: bytes) -> memoryview:
+		"""Packed RGB `data` as one integer per pixel, `red << 16 | green << 8 | blue`."""
+		ints = bytearray(len(data) // 3 * 4)
+		# lay out each pixel as a native 32 bit integer
+		r, g, b = (2, 1, 0) if sys.byteorder == 'little' else (1, 2, 3)
+		ints[r::4] = data[0::3]
+		ints[g::4] = data[1::3]
+		ints[b::4] = data[2::3]
+		return memoryview(ints).cast('I')
+
+	@property
+	def stats(self) -> ImageStats:
+		"""Palette, runs and deltas of the image, computed on demand and kept until a pixel is set."""
+		if (self._stats is None):
+			self._stats = ImageStats(self)
+		return self._stats
+
+	@stats.setter
+	def stats(self, stats: ImageStats | None) -> None:
+		self._stats = stats
+
+	@property
+	def pixels(self) -> PixelView:
+		"""Read-only view of the pixels, built one at a time from the packed buffer (use `data` when possible).
+
+		Set a pixel with `img[x, y] = pixel`, or all of them by assigning `pixels` or writing to `data`.
+		"""
+		return PixelView(self)
+
+	@pixels.setter
+	def pixels(self, pixels: list[Pixel]) -> None:
+		if len(pixels) != self.width * self.height:
+			raise Exception('Invalid number of pixels')
+		self.data = self.pack(pixels)
+		self._stats = None
 
 	def __getitem__(self, pos: tuple[int, int]) -> Pixel:
 		x, y = pos
 
 		if x < 0 or x >= self.width or y < 0 or y >= self.height:
 			raise IndexError('Index out of range')
-		return self.pixels[y * self.width + x]
+		i = (y * self.width + x) * 3
+		return Pixel.from_rgb(self.data[i], self.data[i+1], self.data[i+2])
 
 	def __setitem__(self, pos: tuple[int, int], pix: Pixel) -> None:
 		x, y = pos
 
 		if x < 0 or x >= self.width or y < 0 or y >= self.height:
 			raise IndexError('Index out of range')
-		self.pixels[y * self.width + x] = pix
+		i = (y * self.width + x) * 3
+		self.data[i:i+3] = (pix.red, pix.green, pix.blue)
+		self._stats = None
 
 	def __eq__(self, other: 'Image') -> bool:
-		return self.width == other.width and self.height == other.height and self.pixels == other.pixels
+		return self.width == other.width and self.height == other.height and self.data == other.data
 
 	def __ne__(self, other: 'Image') -> bool: # not asked
 		return not self == other
-	
+
 	def __str__(self) -> str: # not asked
 		return f"Image: {self.width}x{self.height} \n{self.pixels}"
 
 	def __repr__(self) -> str: # not asked
 		return str(self)
-
@@ -0,0 +1,92 @@
+"""Index of the headers of every ULBMP file of a directory tree, in an SQLite database.
+
+usage: python indexer.py [-h] [--db FILE] [-j N] ROOT [ROOT ...]
+
+Only the headers are read (see `Decoder.probe`), by `-j` threads. A file already indexed with
+the same size and modification time is not read again, files gone from the tree are removed.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from encoding import Decoder
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS files (
+	path TEXT PRIMARY KEY,
+	size INTEGER NOT NULL,
+	mtime INTEGER NOT NULL,
+	version INTEGER,
+	width INTEGER,
+	height INTEGER,
+	depth INTEGER,
+	rle INTEGER,
+	colors INTEGER,
+	chunk_rows INTEGER,
+	cached INTEGER,
+	error TEXT
+)"""
+
+def probe_row(path: str, size: int, mtime: int) -> tuple:
+	"""Row of the index for the file at `path`, with the error instead of the header if it cannot be read."""
+	try:
+		header = Decoder.probe(path)
+	except Exception as e:
+		return (path, size, mtime, None, None, None, None, None, None, None, None, str(e) or type(e).__name__)
+	return (path, size, mtime, header.version, header.width, header.height, header.depth, header.compression,
+		len(header.palette or []), header.chunk_rows, int(header.cached), None)
+
+def scan(roots: list[str]) -> dict[str, tuple[int, int]]:
+	"""(size, modification time in ns) of every .ulbmp file under `roots`, by absolute path."""
+	files = {}
+
+	for root in roots:
+		for directory, _, names in os.walk(root):
+			for name in names:
+				if (name.lower().endswith('.ulbmp')):
+					path = os.path.abspath(os.path.join(directory, name))
+					try:
+						stat = os.stat(path)
+					except OSError:
+						continue
+					files[path] = (stat.st_size, stat.st_mtime_ns)
+	return files
+
+def build_index(roots: list[str], db: str, workers: int=16) -> tuple[int, int, int]:
+	"""Bring the index in the database `db` up to date with the files under `roots`.
+
+	Return the number of files probed, unchanged and removed.
+	"""
+	connection = sqlite3.connect(db)
+	try:
+		connection.execute(SCHEMA)
+		known = {path: (size, mtime) for path, size, mtime in connection.execute('SELECT path, size, mtime FROM files')}
+		files = scan(roots)
+
+		changed = [(path, size, mtime) for path, (size, mtime) in files.items() if (known.get(path) != (size, mtime))]
+		gone = [(path,) for path in known if (path not in files)]
+		with ThreadPoolExecutor(workers) as pool:
+			rows = pool.map(probe_row, *zip(*changed)) if (changed) else []
+			with connection:
+				connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+				connection.executemany('DELETE FROM files WHERE path = ?', gone)
+	finally:
+		connection.close()
+	return len(changed), len(files) - len(changed), len(gone)
+
+def main(*args: str) -> None:
+	parser = argparse.ArgumentParser(prog='indexer', description='Index the headers of the ULBMP files of directory trees.')
+	parser.add_argument('roots', nargs='+', metavar='ROOT', help='directories to index')
+	parser.add_argument('--db', default='ulbmp_index.sqlite', help='SQLite database of the index (default: ulbmp_index.sqlite)')
+	parser.add_argument('-j', '--jobs', type=int, default=16, help='threads reading headers (default: 16)')
+	options = parser.parse_args(args)
+
+	start = time.perf_counter()
+	probed, unchanged, removed = build_index(options.roots, options.db, max(options.jobs, 1))
+	elapsed = time.perf_counter() - start
+	print(f"{probed} probed, {unchanged} unchanged, {removed} removed in {elapsed:.2f} s", file=sys.stderr)
+
+if __name__ == "__main__":
+	main(*sys.argv[1:])
@@ -1,37 +1,81 @@
 def rgb(r, g, b): return f"\u001b[38;2;{r};{g};{b}m" # not asked
 
+SHARED_MAX = 1 << 16 # most pixels kept by `Pixel.from_rgb`, all are dropped once there are that many
+
 class Pixel:
-	"""Represents a pixel in an image with a given red, green, and blue value."""
+	"""Represents a pixel in an image with a given red, green, and blue value.
+
+	Pixels are immutable and only hold their packed `rgb` value, which they are compared and
+	hashed by. `Pixel.from_rgb` returns a shared pixel for each color, for palettes and runs
+	(the colors are forgotten every SHARED_MAX of them).
+	"""
+	__slots__ = ('_rgb',)
+	_shared: dict[int, 'Pixel'] = {}
+
 	def __init__(self, red: int, green: int, blue: int):
-		if (red < 0 or red > 255 or green < 0 or green > 255 or blue < 0 or blue > 255):
+		# a negative value or one over 255 leaves bits past the 8 low ones
+		if ((red | green | blue) >> 8):
 			raise Exception('Invalid color value')
-		
-		self._red = red
-		self._green = green
-		self._blue = blue
+
+		_set_rgb(self, red << 16 | green << 8 | blue)
+
+	@staticmethod
+	def from_rgb(red: int, green: int, blue: int) -> 'Pixel':
+		"""Pixel of a color, the same object as the previous calls with that color (since the colors were last forgotten)."""
+		if ((red | green | blue) >> 8):
+			raise Exception('Invalid color value')
+
+		key = red << 16 | green << 8 | blue
+		shared = Pixel._shared
+		pixel = shared.get(key)
+		if (pixel is None):
+			# the color is checked, the pixel is built without `__init__`
+			pixel = new_pixel(Pixel)
+			_set_rgb(pixel, key)
+			if (len(shared) >= SHARED_MAX):
+				shared.clear()
+			shared[key] = pixel
+		return pixel
+
+	def __setattr__(self, name, value):
+		raise AttributeError('Pixel is immutable')
+
+	def __delattr__(self, name):
+		raise AttributeError('Pixel is immutable')
+
+	def __reduce__(self):
+		return (Pixel, (self.red, self.green, self.blue))
 
 	def __str__(self): # not asked
-		return f"{rgb(self._red, self._green, self._blue)}██\u001b[0m"
+		return f"{rgb(self.red, self.green, self.blue)}██\u001b[0m"
 
 	def __repr__(self): # not asked
 		return str(self)
-	
+
 	def __eq__(self, other: 'Pixel'):
 		if isinstance(other, Pixel):
-			return self._red == other._red and self._green == other._green and self._blue == other._blue
+			return self._rgb == other._rgb
 		return False
-	
+
 	def __hash__(self): # not asked
-		return hash((self._red, self._green, self._blue))
-	
+		return self._rgb
+
 	@property
 	def red(self) -> int:
-		return self._red
-	
+		return self._rgb >> 16
+
 	@property
 	def green(self) -> int:
-		return self._green
-	
+		return (self._rgb >> 8) & 0xff
+
 	@property
 	def blue(self) -> int:
-		return self._blue
+		return self._rgb & 0xff
+
+	@property
+	def rgb(self) -> int:
+		"""Color as one integer, `red << 16 | green << 8 | blue` (as in `Image.packed()`)."""
+		return self._rgb
+
+new_pixel = object.__new__
+_set_rgb = Pixel._rgb.__set__ # the slot is only written when a pixel is built
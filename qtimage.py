@@ -0,0 +1,28 @@
+from PySide6.QtGui import QImage
+
+from image import Image
+
+def to_qimage(img: Image) -> QImage:
+	"""QImage of an image, built from its packed RGB buffer in one copy."""
+	qimage = QImage(img.data, img.width, img.height, img.width * 3, QImage.Format_RGB888)
+	# the QImage above only wraps `img.data`, the copy owns its pixels (rows padded by Qt)
+	return qimage.copy()
+
+def from_qimage(qimage: QImage) -> Image:
+	"""Image of a QImage of any format, read from its bits in one copy."""
+	if (qimage.isNull()):
+		raise Exception('Invalid image')
+	if (qimage.format() != QImage.Format_RGB888):
+		qimage = qimage.convertToFormat(QImage.Format_RGB888)
+
+	width, height, stride = qimage.width(), qimage.height(), qimage.bytesPerLine()
+	row_len = width * 3
+	bits = qimage.constBits()
+	if (stride == row_len):
+		return Image(width, height, bits[:row_len * height])
+
+	# rows are padded to 4 bytes in the QImage
+	data = bytearray(row_len * height)
+	for y in range(height):
+		data[y * row_len:(y + 1) * row_len] = bits[y * stride:y * stride + row_len]
+	return Image(width, height, data)
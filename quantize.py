@@ -0,0 +1,188 @@
+"""Color quantization, to save any image as v3 with a palette of 2 to 256 colors.
+
+The palette is built by median cut on a histogram of the colors at 5 bits per channel, then
+refined by a few k-means steps. Pixels are mapped to it through a lookup table of the nearest
+palette color of each cell of that 32 x 32 x 32 color cube, optionally with ordered (Bayer)
+or Floyd-Steinberg dithering.
+"""
+from collections import Counter
+
+from image import Image
+from pixel import Pixel
+
+BITS = 5 # bits per channel of the cells of the color cube
+SHIFT = 8 - BITS
+CELLS = 1 << BITS # cells per side of the cube
+CELL = bytes(v >> SHIFT for v in range(256)) # channel value -> cell coordinate
+BLOCK = 1 << 20 # pixels mapped at a time
+BAYER = [[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]]
+DITHERS = ('ordered', 'floyd-steinberg')
+
+def center(cell: int) -> int:
+	"""Channel value at the middle of a cell coordinate."""
+	return cell << SHIFT | 1 << (SHIFT - 1)
+
+def histogram(img: Image) -> Counter:
+	"""Pixels of each cell of the color cube, keyed `r << 16 | g << 8 | b` by cell coordinates."""
+	counts = Counter()
+	for start in range(0, len(img.data), BLOCK * 3):
+		counts.update(Image.pack_ints(img.data[start:start + BLOCK * 3].translate(CELL)))
+	return counts
+
+def median_cut(counts: Counter, colors: int) -> list[tuple[int, int, int]]:
+	"""Palette of at most `colors` colors for the cells of `counts`.
+
+	The box with the most pixels times its longest side is split at the median pixel along
+	that side, until there are `colors` boxes or none can be split. Each box gives the mean
+	of its cells weighted by their pixels.
+	"""
+	cells = [(key >> 16, key >> 8 & 0xff, key & 0xff, count) for key, count in counts.items()]
+	boxes = [(*split_score(cells), cells)]
+
+	while len(boxes) < colors:
+		best = max(range(len(boxes)), key=lambda i: boxes[i][0])
+		if (not boxes[best][0]):
+			break
+		_, axis, box = boxes.pop(best)
+
+		box.sort(key=lambda cell: cell[axis])
+		half, seen = sum(cell[3] for cell in box) / 2, 0
+		for split, cell in enumerate(box[:-1], 1):
+			seen += cell[3]
+			if (seen >= half):
+				break
+		boxes += [(*split_score(box[:split]), box[:split]), (*split_score(box[split:]), box[split:])]
+
+	return [mean(box) for _, _, box in boxes]
+
+def split_score(cells: list[tuple[int, int, int, int]]) -> tuple[int, int]:
+	"""Pixels of a box times its longest side, and the axis of that side."""
+	population = sum(cell[3] for cell in cells)
+	sides = [max(values) - min(values) for values in list(zip(*cells))[:3]]
+	side = max(sides)
+	return side * population, sides.index(side)
+
+def mean(cells: list[tuple[int, int, int, int]]) -> tuple[int, int, int]:
+	"""Color at the mean of cells (r, g, b, pixels), weighted by their pixels."""
+	total = sum(cell[3] for cell in cells)
+	return tuple(round(sum(center(cell[c]) * cell[3] for cell in cells) / total) for c in range(3))
+
+def kmeans(counts: Counter, palette: list[tuple[int, int, int]], iterations: int=2) -> list[tuple[int, int, int]]:
+	"""Palette moved `iterations` times to the mean of the cells nearest to each of its colors."""
+	for _ in range(iterations):
+		lut = NearestColor(palette).lut
+		clusters = [[] for _ in palette]
+		for key, count in counts.items():
+			clusters[lut[key]].append((key >> 16, key >> 8 & 0xff, key & 0xff, count))
+		palette = [mean(cells) if (cells) else color for color, cells in zip(palette, clusters)]
+	return palette
+
+class NearestColor:
+	"""Index of the nearest palette color of each cell of the color cube, and the mapping of pixels through it.
+
+	The cube is searched by blocks of 4 x 4 x 4 cells: only the palette colors that can be the
+	nearest to some point of a block are compared for its cells.
+	"""
+	def __init__(self, palette: list[tuple[int, int, int]]):
+		if (not 0 < len(palette) <= 256):
+			raise Exception('Invalid number of colors')
+		self.palette = palette
+		# `lut[r << 16 | g << 8 | b]`, by cell coordinates as in `histogram`
+		self.lut = bytearray((CELLS - 1) << 16 | (CELLS - 1) << 8 | CELLS)
+
+		side = 4
+		offsets = [(i, j, k) for i in range(side) for j in range(side) for k in range(side)]
+		for r0 in range(0, CELLS, side):
+			for g0 in range(0, CELLS, side):
+				for b0 in range(0, CELLS, side):
+					corner = (r0, g0, b0)
+					low = [center(c) for c in corner]
+					high = [center(c + side - 1) for c in corner]
+					near = [sum(max(l - v, 0, v - h) ** 2 for v, l, h in zip(color, low, high)) for color in palette]
+					far = [sum(max(v - l, h - v) ** 2 for v, l, h in zip(color, low, high)) for color in palette]
+					bound = min(far)
+
+					# distance << 8 | index, the smallest is the nearest color
+					best = [1 << 30] * len(offsets)
+					for index, color in enumerate(palette):
+						if (near[index] > bound):
+							continue
+						squares = [[(center(c + d) - v) ** 2 for d in range(side)] for c, v in zip(corner, color)]
+						best = list(map(min, best, [(squares[0][i] + squares[1][j] + squares[2][k]) << 8 | index for i, j, k in offsets]))
+					for (i, j, k), value in zip(offsets, best):
+						self.lut[(r0 + i) << 16 | (g0 + j) << 8 | b0 + k] = value & 0xff
+
+	def indices(self, data: bytes, width: int, dither: str=None) -> bytes:
+		"""Palette index of each pixel of packed RGB rows of `width` pixels."""
+		if (dither == 'floyd-steinberg'):
+			return self.floyd_steinberg(data, width)
+		if (dither == 'ordered'):
+			data = self.ordered(data, width)
+		elif (dither):
+			raise Exception(f'Unknown dithering {dither}')
+
+		lookup = self.lut.__getitem__
+		return b''.join(bytes(map(lookup, Image.pack_ints(data[start:start + BLOCK * 3].translate(CELL))))
+			for start in range(0, len(data), BLOCK * 3))
+
+	def ordered(self, data: bytes, width: int) -> bytearray:
+		"""Pixels offset by a 4 x 4 Bayer matrix, by about the distance between palette colors."""
+		spread = 256 / len(self.palette) ** (1 / 3)
+		tables = [[bytes(min(255, max(0, v + round((t + 0.5) / 16 * spread - spread / 2))) for v in range(256))
+			for t in row] for row in BAYER]
+		out = bytearray(data)
+		row_len = width * 3
+
+		for y in range(len(out) // row_len):
+			row = memoryview(out)[y * row_len:(y + 1) * row_len]
+			for x, table in enumerate(tables[y % 4]):
+				for c in range(3):
+					row[x * 3 + c::12] = row[x * 3 + c::12].tobytes().translate(table)
+		return out
+
+	def floyd_steinberg(self, data: bytes, width: int) -> bytes:
+		"""Palette indices with the error of each pixel spread to its right and lower neighbours (7, 3, 5, 1 / 16).
+
+		Each pixel depends on the previous ones, this goes pixel by pixel and is far slower than
+		the other ways.
+		"""
+		lut = self.lut
+		reds, greens, blues = zip(*self.palette)
+		out = bytearray(len(data) // 3)
+		row_len = width * 3
+		# errors in 16ths, one pixel of margin on each side
+		below = [[0] * (width + 2) for _ in range(3)]
+
+		for y in range(len(data) // row_len):
+			errors, below = below, [[0] * (width + 2) for _ in range(3)]
+			er, eg, eb = errors
+			br, bg, bb = below
+			row = data[y * row_len:(y + 1) * row_len]
+			for x in range(width):
+				r = min(255, max(0, row[x * 3] + (er[x + 1] >> 4)))
+				g = min(255, max(0, row[x * 3 + 1] + (eg[x + 1] >> 4)))
+				b = min(255, max(0, row[x * 3 + 2] + (eb[x + 1] >> 4)))
+				index = lut[(r >> SHIFT) << 16 | (g >> SHIFT) << 8 | b >> SHIFT]
+				out[y * width + x] = index
+
+				for value, error, next_row in ((r - reds[index], er, br), (g - greens[index], eg, bg), (b - blues[index], eb, bb)):
+					error[x + 2] += value * 7
+					next_row[x] += value * 3
+					next_row[x + 1] += value * 5
+					next_row[x + 2] += value
+		return out
+
+def quantize(img: Image, colors: int=256, dither: str=None, iterations: int=2) -> tuple[Image, list[Pixel]]:
+	"""Image reduced to a palette of at most `colors` colors, and that palette.
+
+	`dither` is None, 'ordered' or 'floyd-steinberg', `iterations` the k-means steps after the
+	median cut.
+	"""
+	counts = histogram(img)
+	palette = list(dict.fromkeys(kmeans(counts, median_cut(counts, colors), iterations)))
+	indices = NearestColor(palette).indices(img.data, img.width, dither)
+
+	data = bytearray(len(indices) * 3)
+	for c in range(3):
+		data[c::3] = indices.translate(bytes(color[c] for color in palette).ljust(256, b'\x00'))
+	return Image(img.width, img.height, data), [Pixel.from_rgb(*color) for color in palette]
@@ -0,0 +1,344 @@
+"""Local HTTP service that decodes, crops / scales and re-encodes images in a pool of worker processes.
+
+usage: python server.py [-h] [--host HOST] [--port PORT] [-j N] [--batch-size N] [--max-pending N]
+                        [--max-body MB]
+
+	POST /transcode?to=ulbmp|png&version=1-4&level=0-2&x=&y=&w=&h=&scale=
+		the body is a ULBMP file (or any image Qt can read), the response is the image in `to`
+		(default ulbmp v4). `x`, `y`, `w`, `h` crop it and a `scale` of 1 / k shrinks it k
+		times, ULBMP sources only decode the rows of the region (see `Reader.load_region`).
+	GET /metrics	counters, latency percentiles and throughput, as JSON
+	GET /health
+
+Everything stays in memory: the codecs read and write bytes. A request goes to a worker as
+soon as one is free, only the backlog past the number of workers is gathered in batches of up
+to `--batch-size`, one batch is one task of the pool, at most one per worker runs at a time.
+Past `--max-pending` requests being read or processed, new ones are answered 503 before their
+body is read, bodies over `--max-body` MB are 413.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+from encoding import Decoder, Encoder
+from image import Image
+from ulbmp import smallest_depth
+
+TARGETS = ('ulbmp', 'png')
+CONTENT_TYPES = {'ulbmp': 'image/x-ulbmp', 'png': 'image/png'}
+WINDOW = 10 # seconds of requests the throughput is measured over
+LATENCIES = 4096 # latest requests the latency percentiles are computed over
+
+def png_bytes(img: Image) -> bytes:
+	"""PNG file of an image (8 bit RGB, no filtering), in memory."""
+	def chunk(kind: bytes, data: bytes) -> bytes:
+		return len(data).to_bytes(4) + kind + data + zlib.crc32(kind + data).to_bytes(4)
+
+	row_len = img.width * 3
+	rows = bytearray(len(img.data) + img.height)
+	view = memoryview(img.data)
+	for y in range(img.height):
+		rows[y * (row_len + 1) + 1:(y + 1) * (row_len + 1)] = view[y * row_len:(y + 1) * row_len]
+	header = img.width.to_bytes(4) + img.height.to_bytes(4) + bytes([8, 2, 0, 0, 0])
+	return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows, 6)) + chunk(b'IEND', b'')
+
+def read_image(payload: bytes, region: tuple[int, int, int, int]=None, scale: float=1) -> Image:
+	"""Image of a ULBMP file or of any image Qt can read (headless), cropped to `region` and shrunk by `scale`."""
+	if (payload[:5] != b'ULBMP'):
+		from PySide6.QtGui import QImage
+		from qtimage import from_qimage
+		qimage = QImage.fromData(payload)
+		if (qimage.isNull()):
+			raise Exception('Unreadable image')
+		img = from_qimage(qimage)
+		if (region is None and scale == 1):
+			return img
+		payload = Encoder(img, 1).to_bytes() # cropped and shrunk as any v1 file
+	return Decoder.load_from(payload, region=region, scale=scale)
+
+def transcode(payload: bytes, options: dict) -> bytes:
+	"""The image in `payload` converted as the `options` of a request say (see `parse_options`)."""
+	img = read_image(payload, options['region'], options['scale'])
+	if (options['to'] == 'png'):
+		return png_bytes(img)
+
+	version = options['version']
+	if (version == 3):
+		depth = smallest_depth(len(img.stats.colors(256)))
+		return Encoder(img, 3, depth=depth, quantize=True).to_bytes()
+	return Encoder(img, version, level=options['level'] if (version == 4) else 0).to_bytes()
+
+def transcode_batch(jobs: list[tuple[bytes, dict]]) -> list[tuple[bool, bytes | str]]:
+	"""(True, output) or (False, error) of each (payload, options) of `jobs`, run in a worker process."""
+	results = []
+	for payload, options in jobs:
+		try:
+			results.append((True, transcode(payload, options)))
+		except Exception as e:
+			results.append((False, str(e) or type(e).__name__))
+	return results
+
+def parse_options(query: str) -> dict:
+	"""Options of a transcode request from its query string, raises ValueError on a bad one."""
+	params = {key: values[-1] for key, values in parse_qs(query).items()}
+	options = {'to': params.get('to', 'ulbmp'), 'version': int(params.get('version', 4)), 'level': int(params.get('level', 0)),
+		'scale': float(params.get('scale', 1)), 'region': None}
+
+	if (options['to'] not in TARGETS):
+		raise ValueError(f"Unknown target {options['to']}")
+	if (options['version'] not in (1, 2, 3, 4)):
+		raise ValueError(f"Unknown version {options['version']}")
+	if (options['level'] not in (0, 1, 2)):
+		raise ValueError(f"Unknown level {options['level']}")
+	if (not 0 < options['scale'] <= 1):
+		raise ValueError('The scale must be in ]0, 1]')
+	crop = [params.get(key) for key in ('x', 'y', 'w', 'h')]
+	if (any(value is not None for value in crop)):
+		if (None in crop):
+			raise ValueError('A crop needs x, y, w and h')
+		options['region'] = tuple(map(int, crop))
+	return options
+
+def percentile(values: list[float], p: float) -> float:
+	"""Value below which `p` % of the sorted `values` are (nearest rank)."""
+	return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))] if (values) else 0
+
+class Metrics:
+	"""Counters of the server, with the latency and size of its latest requests."""
+	def __init__(self):
+		self.start = time.monotonic()
+		self.requests = 0 # transcode requests answered, failed ones included
+		self.errors = 0
+		self.rejected = 0 # 503 and 413
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.batches = 0
+		self.batched = 0 # requests run in batches
+		self.latest = deque(maxlen=LATENCIES) # (end, seconds, bytes in + out)
+
+	def record(self, start: float, size: int, failed: bool) -> None:
+		end = time.monotonic()
+		self.requests += 1
+		self.errors += failed
+		self.latest.append((end, end - start, size))
+
+	def snapshot(self, pending: int) -> dict:
+		now = time.monotonic()
+		latencies = sorted(seconds for _, seconds, _ in self.latest)
+		recent = [(seconds, size) for end, seconds, size in self.latest if (end > now - WINDOW)]
+		window = min(WINDOW, now - self.start) or 1
+		return {
+			'uptime': round(now - self.start, 3),
+			'requests': self.requests, 'errors': self.errors, 'rejected': self.rejected, 'pending': pending,
+			'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+			'batches': self.batches, 'mean_batch': round(self.batched / self.batches, 2) if (self.batches) else 0,
+			'latency_ms': {f'p{p}': round(percentile(latencies, p) * 1000, 3) for p in (50, 95, 99)}
+				| {'max': round(latencies[-1] * 1000, 3) if (latencies) else 0},
+			'throughput': {'requests_per_s': round(len(recent) / window, 2), 'mb_per_s': round(sum(size for _, size in recent) / 1e6 / window, 3)},
+		}
+
+class Batcher:
+	"""Runs transcode requests in a process pool, the backlog past the number of workers in batches."""
+	def __init__(self, pool: ProcessPoolExecutor, workers: int, size: int, metrics: Metrics):
+		self.pool = pool
+		self.workers = workers
+		self.size = size
+		self.metrics = metrics
+		self.queue = asyncio.Queue()
+		self.free = workers # workers without a batch
+		self.freed = asyncio.Event()
+		self.tasks = set()
+		self.task = asyncio.create_task(self.run())
+
+	def submit(self, payload: bytes, options: dict) -> asyncio.Future:
+		"""Future of the (ok, output or error) of a request."""
+		future = asyncio.get_running_loop().create_future()
+		self.queue.put_nowait((payload, options, future))
+		return future
+
+	async def run(self) -> None:
+		while True:
+			batch = [await self.queue.get()]
+			while (not self.free):
+				self.freed.clear()
+				await self.freed.wait()
+			# the waiting requests are spread over all the workers, one each until there are more of them
+			size = min(self.size, -(-(self.queue.qsize() + 1) // self.workers))
+			while len(batch) < size:
+				batch.append(self.queue.get_nowait())
+			self.free -= 1
+			task = asyncio.create_task(self.dispatch(batch))
+			self.tasks.add(task)
+			task.add_done_callback(self.tasks.discard)
+
+	async def dispatch(self, batch: list[tuple[bytes, dict, asyncio.Future]]) -> None:
+		self.metrics.batches += 1
+		self.metrics.batched += len(batch)
+		try:
+			jobs = [(payload, options) for payload, options, _ in batch]
+			results = await asyncio.get_running_loop().run_in_executor(self.pool, transcode_batch, jobs)
+			for (_, _, future), result in zip(batch, results):
+				if (not future.done()):
+					future.set_result(result)
+		except Exception as e: # the pool itself failed, e.g. a worker was killed
+			for _, _, future in batch:
+				if (not future.done()):
+					future.set_result((False, str(e) or type(e).__name__))
+		finally:
+			self.free += 1
+			self.freed.set()
+
+	async def close(self) -> None:
+		self.task.cancel()
+		for task in [self.task, *self.tasks]:
+			try:
+				await task
+			except asyncio.CancelledError:
+				pass
+
+class ImageServer:
+	"""HTTP/1.1 server (keep-alive, Content-Length bodies) over asyncio streams, see the module docstring."""
+	def __init__(self, workers: int=os.cpu_count(), batch_size: int=8, max_pending: int=64, max_body: int=64 << 20):
+		self.workers = max(workers, 1)
+		self.batch_size = max(batch_size, 1)
+		self.max_pending = max_pending
+		self.max_body = max_body
+		self.metrics = Metrics()
+		self.pending = 0 # transcode requests whose body is being read or processed
+		self.pool = None
+		self.batcher = None
+		self.server = None
+
+	async def start(self, host: str='127.0.0.1', port: int=8000) -> tuple[str, int]:
+		"""Start the workers and listen, return the address listened on (`port` 0 picks a free one)."""
+		# spawned, forked workers would hold copies of the sockets open when they start
+		self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+		self.batcher = Batcher(self.pool, self.workers, self.batch_size, self.metrics)
+		self.server = await asyncio.start_server(self.handle, host, port)
+		return self.server.sockets[0].getsockname()[:2]
+
+	async def close(self) -> None:
+		if (self.server is not None):
+			self.server.close()
+			await self.server.wait_closed()
+		if (self.batcher is not None):
+			await self.batcher.close()
+		if (self.pool is not None):
+			self.pool.shutdown(cancel_futures=True)
+
+	async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+		"""Answer the requests of a connection until it is closed."""
+		try:
+			while True:
+				line = await reader.readline()
+				if (not line):
+					break
+				method, target, version = line.decode('latin-1').split()
+				headers = {}
+				while (header := await reader.readline()) not in (b'\r\n', b'\n', b''):
+					name, _, value = header.decode('latin-1').partition(':')
+					headers[name.strip().lower()] = value.strip()
+				keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+				length = int(headers.get('content-length', 0))
+				if (length > self.max_body):
+					self.metrics.rejected += 1
+					await self.respond(writer, 413, b'Body too large\n', close=True)
+					break
+				transcoding = method == 'POST' and urlsplit(target).path == '/transcode'
+				if (transcoding):
+					if (self.pending >= self.max_pending):
+						self.metrics.rejected += 1
+						await self.respond(writer, 503, b'Too many requests pending\n', extra={'Retry-After': 1}, close=True)
+						break
+					self.pending += 1 # from the body on, so the bodies held at a time are bounded
+				try:
+					body = await reader.readexactly(length)
+					status, content_type, data, extra = await self.route(method, target, body)
+				finally:
+					if (transcoding):
+						self.pending -= 1
+				await self.respond(writer, status, data, content_type, extra, close=not keep_alive)
+				if (not keep_alive):
+					break
+		except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+			pass # malformed request or client gone, the connection is dropped
+		finally:
+			writer.close()
+
+	async def respond(self, writer: asyncio.StreamWriter, status: int, data: bytes, content_type: str='text/plain', extra: dict=None,
+		close: bool=False) -> None:
+		headers = {'Content-Type': content_type, 'Content-Length': len(data), **(extra or {})}
+		if (close):
+			headers['Connection'] = 'close'
+		head = f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n" + ''.join(f"{name}: {value}\r\n" for name, value in headers.items())
+		writer.write(head.encode('latin-1') + b'\r\n')
+		writer.write(data)
+		await writer.drain()
+
+	async def route(self, method: str, target: str, body: bytes) -> tuple[int, str, bytes, dict]:
+		"""(status, content type, body, extra headers) of the response to a request."""
+		url = urlsplit(target)
+		if (url.path == '/health' and method == 'GET'):
+			return 200, 'text/plain', b'ok\n', {}
+		if (url.path == '/metrics' and method == 'GET'):
+			return 200, 'application/json', json.dumps(self.metrics.snapshot(self.pending)).encode() + b'\n', {}
+		if (url.path == '/transcode' and method == 'POST'):
+			return await self.transcode(url.query, body)
+		if (url.path in ('/health', '/metrics', '/transcode')):
+			return 405, 'text/plain', b'Method not allowed\n', {}
+		return 404, 'text/plain', b'Not found\n', {}
+
+	async def transcode(self, query: str, body: bytes) -> tuple[int, str, bytes, dict]:
+		start = time.monotonic()
+		try:
+			options = parse_options(query)
+		except ValueError as e:
+			return 400, 'text/plain', f"{e}\n".encode(), {}
+
+		self.metrics.bytes_in += len(body)
+		ok, result = await self.batcher.submit(body, options)
+		if (not ok):
+			self.metrics.record(start, len(body), True)
+			return 422, 'text/plain', f"{result}\n".encode(), {}
+		self.metrics.bytes_out += len(result)
+		self.metrics.record(start, len(body) + len(result), False)
+		return 200, CONTENT_TYPES[options['to']], result, {}
+
+async def serve(host: str, port: int, **kwargs) -> None:
+	"""Run the server until it is interrupted."""
+	server = ImageServer(**kwargs)
+	try:
+		host, port = await server.start(host, port)
+		print(f"Listening on http://{host}:{port} with {server.workers} workers", file=sys.stderr)
+		await server.server.serve_forever()
+	finally:
+		await server.close()
+
+def main(*args: str) -> int:
+	parser = argparse.ArgumentParser(prog='server', description='Serve ULBMP decoding, thumbnails and conversions over HTTP.')
+	parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+	parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: 8000)')
+	parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='worker processes (default: one per CPU)')
+	parser.add_argument('--batch-size', type=int, default=8, help='most requests run by a worker in one task (default: 8)')
+	parser.add_argument('--max-pending', type=int, default=64, help='requests read or processed at a time, more are answered 503 (default: 64)')
+	parser.add_argument('--max-body', type=float, default=64, help='largest request body in MB, larger are answered 413 (default: 64)')
+	options = parser.parse_args(args)
+
+	try:
+		asyncio.run(serve(options.host, options.port, workers=options.jobs, batch_size=options.batch_size, max_pending=options.max_pending, max_body=int(options.max_body * 1e6)))
+	except KeyboardInterrupt:
+		pass
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,70 @@
+from collections import Counter
+from functools import cached_property
+from itertools import compress
+from operator import ne, sub
+
+from pixel import Pixel
+
+BLOCK = 1 << 16 # pixels added to the palette at a time, between two checks of its size
+
+class ImageStats:
+	"""Analysis of an image shared by the encoders and the viewer: palette, runs and deltas.
+
+	Each part is computed in bulk on the packed pixels the first time it is asked for and kept,
+	an image keeps its stats until one of its pixels is set (see `Image.stats`).
+	"""
+	def __init__(self, img):
+		self.img = img
+		self._colors = set()
+		self._scanned = 0 # pixels already added to `_colors`
+
+	def colors(self, limit: int=None) -> set[int]:
+		"""Colors of the image, `red << 16 | green << 8 | blue`.
+
+		With `limit`, the scan stops as soon as more than `limit` colors are found: the set
+		then holds some of the colors only, but more than `limit` of them.
+		"""
+		data = self.img.data
+		pixels = len(data) // 3
+		while self._scanned < pixels and (limit is None or len(self._colors) <= limit):
+			stop = min(pixels, self._scanned + BLOCK)
+			self._colors.update(self.img.pack_ints(data[self._scanned * 3:stop * 3]))
+			self._scanned = stop
+		return self._colors
+
+	def palette(self, limit: int=None) -> list[Pixel]:
+		"""Colors of the image as pixels, see `colors`."""
+		return [Pixel.from_rgb(color >> 16, (color >> 8) & 0xff, color & 0xff) for color in self.colors(limit)]
+
+	@cached_property
+	def run_histogram(self) -> Counter:
+		"""Number of runs of equal pixels of each length.
+
+		The runs are found from the positions where the pixel changes, `BLOCK` pixels at a time,
+		each block compared with the last pixel of the previous one. The run still open at the
+		end of a block is carried into the next.
+		"""
+		data = self.img.data
+		pixels = len(data) // 3
+		histogram = Counter()
+		start = 0 # first pixel of the open run
+		for first in range(0, pixels, BLOCK):
+			stop = min(pixels, first + BLOCK)
+			before = max(0, first - 1)
+			packed = self.img.pack_ints(data[before * 3:stop * 3])
+			starts = [start, *compress(range(before + 1, stop), map(ne, packed[1:], packed[:-1]))]
+			histogram.update(map(sub, starts[1:], starts[:-1]))
+			start = starts[-1]
+		if (pixels):
+			histogram[pixels - start] += 1
+		return histogram
+
+	def records(self, longest: int=255) -> int:
+		"""Number of (run length, color) records of an RLE of the pixels, with runs up to `longest`."""
+		return sum(count * -(-length // longest) for length, count in self.run_histogram.items())
+
+	@cached_property
+	def deltas(self) -> tuple[Counter, Counter, Counter]:
+		"""Histograms of the red, green and blue differences of each pixel with the previous one (black first)."""
+		data = self.img.data
+		return tuple(Counter(map(sub, data[c::3], b'\x00' + data[c:-3:3])) for c in range(3))
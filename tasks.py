@@ -0,0 +1,40 @@
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+class Cancelled(Exception):
+	''' Raised in a task by its progress callback once it is cancelled '''
+
+class TaskSignals(QObject):
+	''' Signals of a task, emitted from its worker thread '''
+	progress = Signal(int, int) # done, total
+	done = Signal(object) # result
+	failed = Signal(str) # error message, empty when cancelled
+
+class Task(QRunnable):
+	''' Run `function(progress)` in a worker thread.
+
+	`function` calls `progress(done, total)` from its loops (the encoder and decoder take it as
+	`progress`), which is forwarded to the GUI thread and stops the task once it is cancelled.
+	'''
+	def __init__(self, function):
+		super().__init__()
+		self.function = function
+		self.signals = TaskSignals()
+		self.cancelled = False
+
+	def cancel(self) -> None:
+		self.cancelled = True
+
+	def report(self, done: int, total: int) -> None:
+		if (self.cancelled):
+			raise Cancelled()
+		self.signals.progress.emit(done, total)
+
+	def run(self) -> None:
+		try:
+			result = self.function(self.report)
+		except Cancelled:
+			self.signals.failed.emit("")
+		except Exception as e:
+			self.signals.failed.emit(str(e))
+		else:
+			self.signals.done.emit(result)
@@ -0,0 +1,121 @@
+"""Round trips of the ULBMP version flags, and the corruptions `verify` and the decoders must reject."""
+import os
+import random
+import tempfile
+import unittest
+
+from encoding import Decoder, Encoder
+from image import Image
+
+IMAGES = os.path.join(os.path.dirname(__file__), 'imgs')
+
+def photo() -> Image:
+	"""Part of a photo, its last rows repeated for RUN blocks."""
+	img = Decoder.load_from(os.path.join(IMAGES, 'jelly_beans1.ulbmp'), region=(40, 60, 48, 40))
+	row_len = img.width * 3
+	img.data[-8 * row_len:] = img.data[-9 * row_len:-8 * row_len] * 8
+	return img
+
+def palette(colors: int) -> Image:
+	"""Runs of `colors` random colors."""
+	rand = random.Random(colors)
+	table = [rand.randbytes(3) for _ in range(colors)]
+	data = bytearray()
+	while len(data) < 37 * 29 * 3:
+		data += rand.choice(table) * rand.randrange(1, 20)
+	return Image(37, 29, data[:37 * 29 * 3])
+
+# (image, Encoder arguments) of each combination of version and flags
+CASES = [
+	('photo', dict(version=1)),
+	('photo', dict(version=2)),
+	('photo', dict(version=2, chunk_rows=7)),
+	('photo', dict(version=3, depth=24)),
+	('palette16', dict(version=3, depth=4)),
+	('palette16', dict(version=3, depth=8, rle=1)),
+	('palette2', dict(version=3, depth=1)),
+	('photo', dict(version=4)),
+	('photo', dict(version=4, level=1)),
+	('photo', dict(version=4, level=2)),
+	('photo', dict(version=4, chunk_rows=9)),
+	('photo', dict(version=4, chunk_rows=9, level=1)),
+	('photo', dict(version=4, chunk_rows=9, level=2)),
+]
+
+class EncodingTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		images = {'photo': photo(), 'palette16': palette(16), 'palette2': palette(2)}
+		cls.files = []
+		for name, kwargs in CASES:
+			for checksum in (False, True):
+				kwargs = dict(kwargs, checksum=checksum)
+				cls.files.append((images[name], kwargs, Encoder(images[name], **kwargs).to_bytes()))
+
+	def test_round_trip(self):
+		for img, kwargs, data in self.files:
+			with self.subTest(**kwargs):
+				self.assertEqual(Decoder.load_from(data), img)
+				self.assertEqual(Decoder.load_from(data, progress=lambda done, total: None), img)
+				Decoder.verify(data)
+
+	def test_bands(self):
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'image.ulbmp')
+			for img, kwargs, data in self.files:
+				with self.subTest(**kwargs):
+					with open(path, 'wb') as file:
+						file.write(data)
+					self.assertEqual(Decoder.load_from(path, workers=2), img)
+
+	def test_verify_truncated(self):
+		for img, kwargs, data in self.files:
+			with self.subTest(**kwargs), self.assertRaises(Exception):
+				Decoder.verify(data[:-1])
+
+	def test_flipped_bit(self):
+		for img, kwargs, data in self.files:
+			if (not kwargs['checksum']):
+				continue
+			header_len = Decoder.probe(data).header_len
+			for position in (header_len, (header_len + len(data)) // 2, len(data) - 1):
+				with self.subTest(position=position, **kwargs):
+					corrupted = bytearray(data)
+					corrupted[position] ^= 0b00010000
+					with self.assertRaisesRegex(Exception, 'Invalid checksum'):
+						Decoder.verify(bytes(corrupted))
+					with self.assertRaises(Exception):
+						Decoder.load_from(bytes(corrupted))
+
+	def test_flipped_bit_bands(self):
+		# decoding by bands in worker processes compares the checksums too
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'image.ulbmp')
+			for img, kwargs, data in self.files:
+				header = Decoder.probe(data)
+				if (not header.checksum or not (header.fixed_stride() or header.chunk_rows)):
+					continue
+				with self.subTest(**kwargs):
+					corrupted = bytearray(data)
+					corrupted[len(data) // 2] ^= 1
+					with open(path, 'wb') as file:
+						file.write(corrupted)
+					with self.assertRaisesRegex(Exception, 'Invalid checksum'):
+						Decoder.load_from(path, workers=2)
+
+	def test_truncated_v4(self):
+		# a block cut short is a format error, not an IndexError
+		for img, kwargs, data in self.files:
+			if (kwargs['version'] != 4 or kwargs['checksum']):
+				continue
+			for cut in (1, 2, 3):
+				with self.subTest(cut=cut, **kwargs):
+					with self.assertRaises(Exception) as context:
+						Decoder.load_from(data[:-cut])
+					self.assertIs(type(context.exception), Exception)
+					with self.assertRaises(Exception) as context:
+						Decoder.load_from(data[:-cut], progress=lambda done, total: None)
+					self.assertIs(type(context.exception), Exception)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,93 @@
+"""Round trips of the ULBMF frame container, and the damaged files it must reject."""
+import os
+import tempfile
+import unittest
+
+from encoding import Decoder
+from frames import DELTA, HEADER_LEN, KEY, FrameReader, FrameWriter
+from image import Image
+
+IMAGES = os.path.join(os.path.dirname(__file__), 'imgs')
+WIDTH, HEIGHT, TILE = 70, 50, 16 # tiles cut at the right and bottom edges
+
+def sequence() -> list[Image]:
+	"""A few frames: small changes, an unchanged frame and a whole new picture."""
+	first = Decoder.load_from(os.path.join(IMAGES, 'jelly_beans1.ulbmp'), region=(0, 0, WIDTH, HEIGHT))
+	frames = [first]
+	for changed in ((3, 4), (68, 49), None, (20, 30)):
+		data = bytearray(frames[-1].data)
+		if (changed is not None):
+			x, y = changed
+			i = (y * WIDTH + x) * 3
+			data[i:i + 3] = bytes(255 - value for value in data[i:i + 3])
+		frames.append(Image(WIDTH, HEIGHT, data))
+	frames.append(Decoder.load_from(os.path.join(IMAGES, 'house1.ulbmp'), region=(100, 100, WIDTH, HEIGHT)))
+	frames.append(Image(WIDTH, HEIGHT, frames[-1].data[:-3] + bytes(3)))
+	return frames
+
+class FramesTest(unittest.TestCase):
+	def setUp(self):
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		self.path = os.path.join(directory.name, 'frames.ulbmf')
+		self.frames = sequence()
+
+	def write(self, **kwargs) -> bytes:
+		with FrameWriter(self.path, WIDTH, HEIGHT, TILE, **kwargs) as writer:
+			for frame in self.frames:
+				writer.add(frame)
+		with open(self.path, 'rb') as file:
+			return file.read()
+
+	def rewrite(self, data: bytes) -> None:
+		with open(self.path, 'wb') as file:
+			file.write(data)
+
+	def test_round_trip(self):
+		for kwargs in (dict(level=0), dict(level=1), dict(level=2), dict(keyframe=2)):
+			with self.subTest(**kwargs):
+				self.write(**kwargs)
+				with FrameReader(self.path) as reader:
+					self.assertEqual(len(reader), len(self.frames))
+					self.assertEqual(list(reader), self.frames)
+					for i in reversed(range(len(self.frames))):
+						self.assertEqual(reader.frame(i), self.frames[i])
+
+	def test_kinds(self):
+		self.write()
+		with FrameReader(self.path) as reader:
+			self.assertEqual(list(reader.kinds), [KEY, DELTA, DELTA, DELTA, DELTA, KEY, DELTA])
+			# the unchanged frame is its bitmap only
+			self.assertEqual(reader.offsets[4] - reader.offsets[3], 1 + -(-reader.tiles // 8))
+
+	def test_truncated(self):
+		data = self.write()
+		for size in (0, HEADER_LEN - 1, HEADER_LEN, len(data) // 2, len(data) - 1):
+			with self.subTest(size=size):
+				self.rewrite(data[:size])
+				with self.assertRaises(Exception):
+					FrameReader(self.path)
+
+	def test_damaged_index(self):
+		data = self.write()
+		index = int.from_bytes(data[16:24], byteorder='little')
+		for position, value in ((index + 8, DELTA), (index + 9, 0xff)):
+			with self.subTest(position=position):
+				damaged = bytearray(data)
+				damaged[position] = value # the first frame not a key frame, offsets out of order
+				self.rewrite(damaged)
+				with self.assertRaisesRegex(Exception, 'Invalid frame index'):
+					FrameReader(self.path)
+
+	def test_damaged_frame(self):
+		data = self.write()
+		with FrameReader(self.path) as reader:
+			delta = reader.offsets[1] + 1 + -(-reader.tiles // 8) # size of the first stack of tiles
+		damaged = bytearray(data)
+		damaged[delta] ^= 1
+		self.rewrite(damaged)
+		with FrameReader(self.path) as reader, self.assertRaises(Exception):
+			reader.frame(1)
+
+if __name__ == "__main__":
+	unittest.main()
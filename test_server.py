@@ -0,0 +1,86 @@
+"""Tests of server.py against a server listening on localhost."""
+import asyncio
+import json
+import os
+import unittest
+
+from encoding import Decoder
+from server import ImageServer
+
+IMAGE = os.path.join(os.path.dirname(__file__), 'imgs', 'gradients1.ulbmp')
+TIMEOUT = 30 # seconds a request may take, cold workers included
+
+async def request(host: str, port: int, method: str, target: str, body: bytes=b'', send_body: bool=True) -> tuple[int, dict, bytes]:
+	"""(status, headers, body) of one request on its own `Connection: close` connection, read until EOF."""
+	reader, writer = await asyncio.open_connection(host, port)
+	try:
+		writer.write(f"{method} {target} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1'))
+		if (send_body):
+			writer.write(body)
+		await writer.drain()
+		response = await asyncio.wait_for(reader.read(), TIMEOUT) # EOF only once no process holds the socket
+	finally:
+		writer.close()
+	head, _, data = response.partition(b'\r\n\r\n')
+	status, *lines = head.decode('latin-1').split('\r\n')
+	headers = {name.lower(): value.strip() for name, _, value in (line.partition(':') for line in lines)}
+	return int(status.split()[1]), headers, data
+
+class ServerTest(unittest.IsolatedAsyncioTestCase):
+	async def start(self, **kwargs) -> tuple[str, int]:
+		server = ImageServer(**kwargs)
+		self.addAsyncCleanup(server.close)
+		self.server = server
+		return await server.start('127.0.0.1', 0)
+
+	async def test_concurrent_requests(self):
+		host, port = await self.start(workers=4)
+		with open(IMAGE, 'rb') as file:
+			payload = file.read()
+		expected = Decoder.load_from(IMAGE)
+
+		# once cold, then once more with every worker started
+		for _ in range(2):
+			responses = await asyncio.gather(*(request(host, port, 'POST', '/transcode?version=2', payload) for _ in range(8)))
+			for status, headers, data in responses:
+				self.assertEqual(status, 200)
+				self.assertEqual(headers['content-type'], 'image/x-ulbmp')
+				self.assertEqual(int(headers['content-length']), len(data))
+				self.assertEqual(Decoder.load_from(data), expected)
+
+		status, _, data = await request(host, port, 'GET', '/metrics')
+		self.assertEqual(status, 200)
+		metrics = json.loads(data)
+		self.assertEqual(metrics['requests'], 16)
+		self.assertEqual(metrics['errors'], 0)
+		self.assertLessEqual(metrics['mean_batch'], 2) # 8 requests over 4 workers
+
+	async def test_png_region(self):
+		host, port = await self.start(workers=1)
+		with open(IMAGE, 'rb') as file:
+			payload = file.read()
+		status, headers, data = await request(host, port, 'POST', '/transcode?to=png&x=0&y=0&w=4&h=2', payload)
+		self.assertEqual(status, 200)
+		self.assertEqual(headers['content-type'], 'image/png')
+		self.assertEqual(data[:8], b'\x89PNG\r\n\x1a\n')
+		self.assertEqual((int.from_bytes(data[16:20]), int.from_bytes(data[20:24])), (4, 2))
+
+	async def test_errors(self):
+		host, port = await self.start(workers=1, max_body=1000)
+		self.assertEqual((await request(host, port, 'GET', '/health'))[0], 200)
+		self.assertEqual((await request(host, port, 'GET', '/nowhere'))[0], 404)
+		self.assertEqual((await request(host, port, 'GET', '/transcode'))[0], 405)
+		self.assertEqual((await request(host, port, 'POST', '/transcode?version=5', b'ULBMP'))[0], 400)
+		self.assertEqual((await request(host, port, 'POST', '/transcode', b'ULBMP'))[0], 422)
+		self.assertEqual((await request(host, port, 'POST', '/transcode', bytes(1001), send_body=False))[0], 413)
+
+	async def test_pending_before_body(self):
+		host, port = await self.start(workers=1, max_pending=0)
+		# the body is never sent, the 503 must not wait for it
+		status, headers, _ = await request(host, port, 'POST', '/transcode', bytes(1000), send_body=False)
+		self.assertEqual(status, 503)
+		self.assertEqual(headers['retry-after'], '1')
+		self.assertEqual(self.server.pending, 0)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,211 @@
+import math
+from collections import OrderedDict
+
+from PySide6.QtCore import QObject, QRectF, QRunnable, QThreadPool, Signal
+from PySide6.QtGui import QColor, QImage, QPixmap
+from PySide6.QtWidgets import QGraphicsItem, QGraphicsView
+
+from encoding import Reader
+from image import Image
+
+TILE = 256 # side of a tile, in pixels of its level
+BACKGROUND = QColor(40, 40, 40) # drawn where no tile is ready yet
+
+class TileSource:
+	"""Pixels of an image in memory or of a file open with a `Reader` (only the rows needed are decoded).
+
+	From a file, the rows of a band of tiles are decoded once, across the whole width, and the
+	tiles of the band are cut from it. The latest bands are kept, up to `max_bytes` (at least one).
+	"""
+	def __init__(self, source: Image | Reader, max_bytes: int=256 << 20):
+		self.source = source
+		self.width = source.width
+		self.height = source.height
+		self.bands = OrderedDict() # (y, height, step) -> packed RGB of every step-th pixel of every step-th row
+		self.band_bytes = 0
+		self.max_bytes = max_bytes
+
+	@staticmethod
+	def subsample(row: bytes, step: int) -> bytes:
+		"""Every `step`-th pixel of a row of packed RGB."""
+		if (step == 1):
+			return bytes(row)
+		pixels = bytearray(-(-len(row) // (3 * step)) * 3)
+		pixels[0::3] = row[0::3 * step]
+		pixels[1::3] = row[1::3 * step]
+		pixels[2::3] = row[2::3 * step]
+		return pixels
+
+	def band(self, y: int, height: int, step: int) -> bytes:
+		"""Every `step`-th pixel of every `step`-th row of the rows `y` to `y + height`, decoded from the file once."""
+		key = (y, height, step)
+		band = self.bands.get(key)
+		if (band is not None):
+			self.bands.move_to_end(key)
+			return band
+
+		if (step == 1):
+			rows = self.source.rows(y, y + height)
+			band = bytes(rows)
+			if (isinstance(rows, memoryview)):
+				rows.release()
+		else:
+			# the rows are read in order, a sequential payload is decoded at most once per band
+			band = bytearray()
+			for row_y in range(y, y + height, step):
+				rows = self.source.rows(row_y, row_y + 1)
+				band += self.subsample(rows, step)
+				if (isinstance(rows, memoryview)):
+					rows.release()
+
+		self.bands[key] = band
+		self.band_bytes += len(band)
+		while (self.band_bytes > self.max_bytes and len(self.bands) > 1):
+			self.band_bytes -= len(self.bands.popitem(last=False)[1])
+		return band
+
+	def region(self, x: int, y: int, width: int, height: int, step: int=1) -> bytearray:
+		"""Packed RGB of every `step`-th pixel of every `step`-th row of a region (nearest, no filtering).
+
+		From a file, `x` must be a multiple of `step` (tiles are).
+		"""
+		if (isinstance(self.source, Image)):
+			row_len = self.width * 3
+			out = bytearray()
+			for row_y in range(y, y + height, step):
+				start = row_y * row_len + x * 3
+				out += self.subsample(self.source.data[start:start + width * 3], step)
+			return out
+
+		band = self.band(y, height, step)
+		band_len = -(-self.width // step) * 3
+		start, size = x // step * 3, -(-width // step) * 3
+		return bytearray().join(band[i + start:i + start + size] for i in range(0, len(band), band_len))
+
+	def close(self) -> None:
+		self.bands.clear()
+		self.band_bytes = 0
+		if (isinstance(self.source, Reader)):
+			self.source.close()
+
+class TileSignals(QObject):
+	''' Signals of the tile jobs, emitted from the worker thread '''
+	ready = Signal(int, int, int, QImage)
+
+class TileJob(QRunnable):
+	''' Render one tile in the background '''
+	def __init__(self, item: 'TiledImageItem', level: int, tx: int, ty: int):
+		super().__init__()
+		self.item = item
+		self.key = (level, tx, ty)
+
+	def run(self) -> None:
+		level, tx, ty = self.key
+		# the zoom changed since the tile was asked for
+		qimage = self.item.render_tile(level, tx, ty) if (level == self.item.level) else QImage()
+		self.item.signals.ready.emit(level, tx, ty, qimage)
+
+class TiledImageItem(QGraphicsItem):
+	''' Image drawn from a pyramid of tiles, each level half the size of the one below.
+
+	Only the tiles in view are drawn, at the level matching the zoom. Missing tiles are rendered
+	by a background thread and stood in for by a coarser tile (or the background) meanwhile.
+	At most `max_tiles` tiles are kept, the least recently drawn go first.
+	'''
+	def __init__(self, source: Image | Reader, max_tiles: int=1024):
+		super().__init__()
+		self.source = TileSource(source)
+		self.width = self.source.width
+		self.height = self.source.height
+		# level of a single tile for the whole image
+		self.levels = max(0, math.ceil(math.log2(max(self.width, self.height) / TILE)))
+		self.level = 0
+		self.tiles = OrderedDict() # (level, tx, ty) -> QPixmap
+		self.max_tiles = max_tiles
+		self.pending = set()
+
+		self.pool = QThreadPool()
+		self.pool.setMaxThreadCount(1) # the source is read by one thread at a time
+		self.signals = TileSignals()
+		self.signals.ready.connect(self.tile_ready)
+		self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+	def boundingRect(self) -> QRectF:
+		return QRectF(0, 0, self.width, self.height)
+
+	def tile_rect(self, level: int, tx: int, ty: int) -> QRectF:
+		''' Part of the image covered by a tile '''
+		size = TILE << level
+		return QRectF(tx * size, ty * size, min(size, self.width - tx * size), min(size, self.height - ty * size))
+
+	def render_tile(self, level: int, tx: int, ty: int) -> QImage:
+		''' Pixels of a tile, every 2^level pixel of the image (worker thread) '''
+		rect = self.tile_rect(level, tx, ty)
+		step = 1 << level
+		width, height = -(-int(rect.width()) // step), -(-int(rect.height()) // step)
+		data = self.source.region(int(rect.x()), int(rect.y()), int(rect.width()), int(rect.height()), step)
+		return QImage(data, width, height, width * 3, QImage.Format_RGB888).copy()
+
+	def tile_ready(self, level: int, tx: int, ty: int, qimage: QImage) -> None:
+		''' Keep a rendered tile and redraw its part of the image (GUI thread) '''
+		self.pending.discard((level, tx, ty))
+		if (qimage.isNull()):
+			return
+		self.tiles[(level, tx, ty)] = QPixmap.fromImage(qimage)
+		while (len(self.tiles) > self.max_tiles):
+			self.tiles.popitem(last=False)
+		self.update(self.tile_rect(level, tx, ty))
+
+	def paint(self, painter, option, widget=None) -> None:
+		scale = option.levelOfDetailFromTransform(painter.worldTransform())
+		self.level = 0 if (scale >= 1) else min(self.levels, int(math.log2(1 / scale)))
+		size = TILE << self.level
+		rect = option.exposedRect.intersected(self.boundingRect())
+
+		for ty in range(int(rect.top()) // size, math.ceil(rect.bottom() / size)):
+			for tx in range(int(rect.left()) // size, math.ceil(rect.right() / size)):
+				self.draw_tile(painter, self.level, tx, ty)
+
+	def draw_tile(self, painter, level: int, tx: int, ty: int) -> None:
+		''' Draw a tile, or ask for it and draw a coarser one in its place '''
+		target = self.tile_rect(level, tx, ty)
+		pixmap = self.tiles.get((level, tx, ty))
+		if (pixmap is not None):
+			self.tiles.move_to_end((level, tx, ty))
+			painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+			return
+
+		if ((level, tx, ty) not in self.pending):
+			self.pending.add((level, tx, ty))
+			self.pool.start(TileJob(self, level, tx, ty))
+
+		for coarser in range(level + 1, self.levels + 1):
+			size = TILE << coarser
+			key = (coarser, int(target.x()) // size, int(target.y()) // size)
+			parent = self.tiles.get(key)
+			if (parent is not None):
+				scale = 1 << coarser
+				source = QRectF((target.x() - key[1] * size) / scale, (target.y() - key[2] * size) / scale,
+					target.width() / scale, target.height() / scale)
+				painter.drawPixmap(target, parent, source)
+				return
+		painter.fillRect(target, BACKGROUND)
+
+	def close(self) -> None:
+		''' Stop rendering tiles and close the source '''
+		self.pool.clear()
+		self.pool.waitForDone()
+		self.source.close()
+
+class ImageView(QGraphicsView):
+	''' Graphics view zoomed with the wheel (around the cursor) and panned by dragging '''
+	def __init__(self):
+		super().__init__()
+		self.setDragMode(QGraphicsView.ScrollHandDrag)
+		self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+		self.setViewportUpdateMode(QGraphicsView.SmartViewportUpdate)
+		self.setBackgroundBrush(BACKGROUND)
+
+	def wheelEvent(self, event) -> None:
+		factor = 1.25 ** (event.angleDelta().y() / 120)
+		self.scale(factor, factor)
@@ -0,0 +1,162 @@
+"""Batch conversion between PNG / BMP / JPEG and the ULBMP versions 1 to 4, without the GUI.
+
+usage: python ulbmp.py [-h] (--to {1,2,3,4,auto,png,bmp} | --verify) [-o DIR] [-j N] [--depth D]
+                        [--dither {none,ordered,floyd-steinberg}] [--rle] [--chunk-rows N] [--level L] [--trials N]
+                        [--checksum] PATH [PATH ...]
+
+Every file (directories are walked recursively) is converted in a process pool of `-j` workers,
+next to the source or under `-o` with the same relative path. `--to auto` writes each file
+in the version predicted to be the smallest for it (see `Encoder.auto`). With `--to 3 --depth` 1 to 8,
+an image with more colors than the palette holds is quantized to it (see `quantize`). `--checksum` adds
+the CRC32 of each MB of the payload after it. `--verify` checks the ULBMP files without decoding them
+(see `Decoder.verify`) instead of converting them. A file that fails is reported
+and the run goes on, the exit status is 1 if any file failed.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from encoding import Decoder, Encoder
+from image import Image
+from quantize import DITHERS
+
+EXTENSIONS = ('.ulbmp', '.png', '.bmp', '.jpg', '.jpeg')
+TARGETS = ('1', '2', '3', '4', 'auto', 'png', 'bmp')
+
+def read_image(path: str) -> Image:
+	"""Load a ULBMP file, or any image Qt can read (headless, no `QApplication` needed)."""
+	if (path.lower().endswith('.ulbmp')):
+		return Decoder.load_from(path)
+
+	from PySide6.QtGui import QImage
+	from qtimage import from_qimage
+	qimage = QImage(path)
+	if (qimage.isNull()):
+		raise Exception('Unreadable image')
+	return from_qimage(qimage)
+
+def write_image(img: Image, path: str) -> None:
+	"""Save an image in the format of the extension of `path` (anything but .ulbmp goes through Qt)."""
+	from qtimage import to_qimage
+
+	if (not to_qimage(img).save(path)):
+		raise Exception('Unwritable image')
+
+def smallest_depth(colors: int) -> int:
+	"""Smallest v3 depth with a palette of `colors` colors, 24 (no palette) when there are more than 256."""
+	return next((depth for depth in (1, 2, 4, 8) if colors <= 1 << depth), 24)
+
+def convert(src: str, dst: str, target: str, depth: int=0, rle: bool=False, chunk_rows: int=0, level: int=0, trials: int=0, dither: str=None,
+	checksum: bool=False) -> int:
+	"""Convert the file `src` to `dst` in the `target` format, return the size of `src` in bytes."""
+	if (os.path.abspath(src) == os.path.abspath(dst)):
+		raise Exception('Would overwrite the source, use --output')
+
+	img = read_image(src)
+	os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+
+	if (target in ('png', 'bmp')):
+		write_image(img, dst)
+	elif (target == 'auto'):
+		encoder = Encoder.auto(img, level, trials)
+		encoder.checksum = checksum
+		encoder.save_to(dst)
+	else:
+		version = int(target)
+		if (version == 3):
+			depth = depth or smallest_depth(len(img.stats.colors(256)))
+			encoder = Encoder(img, 3, depth=depth, rle=rle and depth >= 8, quantize=True, dither=dither, checksum=checksum)
+		else:
+			encoder = Encoder(img, version, rle=rle, chunk_rows=chunk_rows, level=level if (version == 4) else 0, checksum=checksum)
+		encoder.save_to(dst)
+	return os.path.getsize(src)
+
+def verify(src: str, dst: str=None) -> int:
+	"""Check the ULBMP file `src` without decoding its pixels, return its size in bytes."""
+	Decoder.verify(src)
+	return os.path.getsize(src)
+
+def find_files(paths: list[str]) -> list[tuple[str, str]]:
+	"""(file, path relative to the argument it was found under) of every image in `paths`."""
+	files = []
+
+	for path in paths:
+		if (not os.path.isdir(path)):
+			files.append((path, os.path.basename(path)))
+			continue
+		for root, dirs, names in os.walk(path):
+			dirs.sort()
+			for name in sorted(names):
+				if (name.lower().endswith(EXTENSIONS)):
+					file = os.path.join(root, name)
+					files.append((file, os.path.relpath(file, path)))
+	return files
+
+def destination(src: str, relative: str, target: str, output: str | None) -> str:
+	"""Path of the converted `src`: its extension replaced, under `output` if given."""
+	base = os.path.join(output, relative) if (output) else src
+	return os.path.splitext(base)[0] + ('.' + target if (target in ('png', 'bmp')) else '.ulbmp')
+
+def progress(done: int, total: int, failed: int, size: int, elapsed: float) -> None:
+	"""Rewrite the progress line on stderr."""
+	elapsed = max(elapsed, 1e-9)
+	sys.stderr.write(f"\r[{done}/{total}] {size / 1e6 / elapsed:.1f} MB/s {done / elapsed:.1f} images/s, {failed} failed ")
+	sys.stderr.flush()
+
+def run(jobs: list[tuple[str, str]], workers: int, task=convert, **kwargs) -> list[tuple[str, str]]:
+	"""Convert (or verify, with `task`) every (src, dst) of `jobs` in a pool of `workers` processes, return the (src, error) of the failures."""
+	failures = []
+	size = 0
+	start = shown = time.perf_counter()
+
+	with ProcessPoolExecutor(workers) as pool:
+		futures = {pool.submit(task, src, dst, **kwargs): src for src, dst in jobs}
+		for done, future in enumerate(as_completed(futures), 1):
+			try:
+				size += future.result()
+			except Exception as e:
+				failures.append((futures[future], str(e) or type(e).__name__))
+			now = time.perf_counter()
+			if (now - shown > 0.1 or done == len(jobs)): # at most 10 updates per second
+				progress(done, len(jobs), len(failures), size, now - start)
+				shown = now
+
+	sys.stderr.write('\n')
+	return failures
+
+def main(*args: str) -> int:
+	parser = argparse.ArgumentParser(prog='ulbmp', description='Convert images to and from the ULBMP format.')
+	parser.add_argument('paths', nargs='+', metavar='PATH', help='files or directories to convert')
+	mode = parser.add_mutually_exclusive_group(required=True)
+	mode.add_argument('--to', choices=TARGETS, help='ULBMP version or image format to write')
+	mode.add_argument('--verify', action='store_true', help='check the ULBMP files instead of converting them')
+	parser.add_argument('-o', '--output', help='directory of the converted files (default: next to the sources)')
+	parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='worker processes (default: one per CPU)')
+	parser.add_argument('--depth', type=int, default=0, choices=(1, 2, 4, 8, 24), help='v3 depth (default: smallest for the palette)')
+	parser.add_argument('--dither', default='none', choices=('none', *DITHERS), help='dithering of the images quantized to --depth (default: none)')
+	parser.add_argument('--rle', action='store_true', help='v3 RLE compression (depth 8 and 24)')
+	parser.add_argument('--chunk-rows', type=int, default=0, help='v2 / v4 rows per independent chunk')
+	parser.add_argument('--level', type=int, default=0, choices=(0, 1, 2), help='v4 compression level (default: 0, 2 with auto)')
+	parser.add_argument('--trials', type=int, default=0, help='with auto, encode the N best predicted formats and keep the smallest')
+	parser.add_argument('--checksum', action='store_true', help='write the checksums of the payload')
+	options = parser.parse_args(args)
+	if (options.to == 'auto' and '--level' not in args):
+		options.level = 2
+
+	if (options.verify):
+		jobs = [(src, None) for src, _ in find_files(options.paths) if (src.lower().endswith('.ulbmp'))]
+		failures = run(jobs, max(options.jobs, 1), verify)
+	else:
+		jobs = [(src, destination(src, relative, options.to, options.output)) for src, relative in find_files(options.paths)]
+		failures = run(jobs, max(options.jobs, 1), target=options.to, depth=options.depth, rle=options.rle, chunk_rows=options.chunk_rows,
+			level=options.level, trials=options.trials, dither=None if (options.dither == 'none') else options.dither, checksum=options.checksum)
+
+	for src, error in failures:
+		print(f"{src}: {error}", file=sys.stderr)
+	print(f"{len(jobs) - len(failures)} {'verified' if (options.verify) else 'converted'}, {len(failures)} failed", file=sys.stderr)
+	return 1 if (failures) else 0
+
+if __name__ == "__main__":
+	sys.exit(main(*sys.argv[1:]))
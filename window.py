@@ -1,18 +1,22 @@
 import sys
-from PySide6.QtWidgets import QApplication, QMainWindow, QLabel, QVBoxLayout, QWidget, QPushButton, QFileDialog, QGraphicsScene, QGraphicsView
-from PySide6.QtWidgets import QErrorMessage, QMessageBox, QInputDialog
-from PySide6.QtCore import Qt, QTimer
-from PySide6.QtGui import QImage, QPixmap, QColor, QPen
+from PySide6.QtWidgets import QApplication, QMainWindow, QLabel, QVBoxLayout, QWidget, QPushButton, QFileDialog, QGraphicsScene
+from PySide6.QtWidgets import QErrorMessage, QMessageBox, QInputDialog, QProgressDialog
+from PySide6.QtCore import Qt, QTimer, QThreadPool
+from PySide6.QtGui import QImage, QPen
 
 
+from cache import ImageCache
 from encoding import Decoder, Encoder
 
 from box import CustomDialog
-import math
 from PySide6.QtWidgets import QColorDialog
 
 from image import Image
-from pixel import Pixel
+from qtimage import from_qimage, to_qimage
+from tasks import Task
+from tiles import ImageView, TiledImageItem
+
+HUGE = 1 << 26 # pixels from which an image is shown from its file, without decoding it whole
 
 class MainWindow(QMainWindow):
 	''' Main window of the application '''
@@ -21,6 +25,9 @@ class MainWindow(QMainWindow):
 
 		self.setWindowTitle("ULBMP viewer")
 
+		# decoded images, opening a file again does not decode it again
+		self.cache = ImageCache()
+
 		# Create a layout for the main window
 		layout = QVBoxLayout()
 
@@ -28,7 +35,7 @@ class MainWindow(QMainWindow):
 		self.init_buttons(layout)
 
 		# Create a graphics view to display the image
-		self.graphics_view = QGraphicsView()
+		self.graphics_view = ImageView()
 		self.graphics_view.setMinimumWidth(640)
 		self.graphics_view.setMinimumHeight(480)
 		self.graphics_view.hide();
@@ -37,6 +44,8 @@ class MainWindow(QMainWindow):
 		# Create a scene to hold the image
 		self.scene = QGraphicsScene()
 		self.graphics_view.setScene(self.scene)
+		self.item = None # tiles of the image shown
+		self.task = None # load / save / convert running in the background
 
 		# Create a widget to hold the layout
 		widget = QWidget()
@@ -117,17 +126,28 @@ class MainWindow(QMainWindow):
 		file_path, _ = file_dialog.getOpenFileName(self, "Load Image", "", "Image Files (*.png , *.jpg, *.jpeg, *.bmp)")
 		
 		if (file_path):
-			try: 
-				img = QImage(file_path)
-				w = img.width()
-				h = img.height()
-				p = [Pixel(img.pixelColor(x, y).red(), img.pixelColor(x, y).green(), img.pixelColor(x, y).blue()) for y in range(h) for x in range(w)]
-				img = Image(w, h, p)
-				file_path = file_path.split(".")[0]
-				Encoder(img, 1,).save_to(file_path + ".ulbmp")
-				self.message("Success", "✔️ Image converted successfully!", "#00ED64", 3000)
-			except Exception as e:
-				self.error_message(f"Encoder error: {str(e)}")
+			def convert(progress):
+				img = from_qimage(QImage(file_path))
+				Encoder(img, 1, progress=progress).save_to(file_path.split(".")[0] + ".ulbmp")
+
+			self.run_task("Converting image...", convert, "Encoder error",
+				lambda _: self.message("Success", "✔️ Image converted successfully!", "#00ED64", 3000))
+
+	def run_task(self, label: str, function, error: str, done) -> None:
+		''' Run `function(progress)` in the background behind a progress dialog with a cancel button, then `done(result)` '''
+		dialog = QProgressDialog(label, "Cancel", 0, 100, self)
+		dialog.setWindowModality(Qt.WindowModal)
+		dialog.setMinimumDuration(300)
+		dialog.setValue(0)
+
+		task = Task(function)
+		task.signals.progress.connect(lambda count, total: dialog.setValue(count * 100 // max(total, 1)))
+		task.signals.done.connect(lambda result: (dialog.reset(), done(result)))
+		task.signals.failed.connect(lambda message: (dialog.reset(), message and self.error_message(f"{error}: {message}")))
+		dialog.canceled.connect(task.cancel)
+		task.setAutoDelete(False)
+		self.task = task
+		QThreadPool.globalInstance().start(task)
 
 	def error_message(self, message: str) -> None:
 		''' Error message box '''
@@ -157,13 +177,7 @@ class MainWindow(QMainWindow):
 
 	def image_to_qimage(self) -> QImage:
 		''' Create a QImage from the loaded image '''
-		qimage = QImage(self.img.width, self.img.height, QImage.Format_RGB32)
-
-		for y in range(self.img.height):
-			for x in range(self.img.width):
-				pixel = self.img[x, y]
-				qimage.setPixelColor(x, y, QColor(pixel.red, pixel.green, pixel.blue))
-		return qimage
+		return to_qimage(self.img)
 
 	def load_image(self) -> None:
 		''' Load an image from a file '''
@@ -174,22 +188,38 @@ class MainWindow(QMainWindow):
 			return
 
 		if (file_path.endswith(".ulbmp")):
-			pixmap = None
 			try:
-				self.img = Decoder().load_from(file_path)
-				pixmap = QPixmap.fromImage(self.image_to_qimage())
+				header = Decoder.probe(file_path)
+				if (header.width * header.height > HUGE):
+					# tiles are decoded from the file as they come into view
+					return self.image_loaded(None, Decoder.open(file_path))
 			except Exception as e:
 				return self.error_message(f"Decoder error: {str(e)}")
-			
-			self.scene.clear()
-			self.scene.addPixmap(pixmap)
-			self.graphics_view.fitInView(self.scene.sceneRect(), Qt.KeepAspectRatio)
-			self.graphics_view.show()
-			self.save_button.setDisabled(False)
-			self.message("Success", "✔️ Image loaded successfully!", "#00ED64", 3000)
+
+			self.run_task("Loading image...", lambda progress: self.cache.load_from(file_path, progress=progress),
+				"Decoder error", lambda img: self.image_loaded(img, img))
 		else:
 			self.error_message("Invalid file format. Please select a .ulbmp file.")
 
+	def image_loaded(self, img: Image, source) -> None:
+		''' Show a loaded image, `img` is None when it is shown from its file '''
+		self.img = img
+		self.show_image(source)
+		self.save_button.setDisabled(self.img is None)
+		self.message("Success", "✔️ Image loaded successfully!", "#00ED64", 3000)
+
+	def show_image(self, source) -> None:
+		''' Show an image (or a file open for reading) as a pyramid of tiles '''
+		if (self.item):
+			self.item.close()
+		self.scene.clear()
+		self.item = TiledImageItem(source)
+		self.scene.addItem(self.item)
+		self.scene.setSceneRect(self.item.boundingRect())
+		self.graphics_view.resetTransform()
+		self.graphics_view.fitInView(self.scene.sceneRect(), Qt.KeepAspectRatio)
+		self.graphics_view.show()
+
 	def save_image(self) -> None:
 		''' Save the image to a file '''
 		file_dialog = QFileDialog()
@@ -199,34 +229,24 @@ class MainWindow(QMainWindow):
 			return
 
 		try:
-			colors = self.getColors()
-			print(len(colors))
-			version, ok = QInputDialog.getInt(self, "Version", "Enter the version:", 1, 1, 4)
+			version, ok = QInputDialog.getItem(self, "Version", "Choose the version:", ["auto", "1", "2", "3", "4"], 0, False)
 
 			if (not ok):
 				return
+			saved = lambda _: self.message("Success", "✔️ Image saved successfully!", "#00ED64", 3000)
+			img = self.img
+			if (version == "auto"):
+				def save(progress):
+					encoder = Encoder.auto(img)
+					encoder.progress = progress
+					encoder.save_to(file_path)
+				return self.run_task("Saving image...", save, "Encoder error", saved)
+			version = int(version)
 
-			depth, checked = None, None
 			if (version == 3):
-				dialog = CustomDialog(self)
-				dialog.setTitles("v3 parameters")
-				dialog.setText("Enter the depth:", " RLE compression")
-				x = str(int(math.log2(len(colors))))
-				index = dialog.comboBox.findText(str(x), Qt.MatchExactly)
-
-				if index == -1:  # If exact value is not found
-					# Find the closest larger value
-					for i in range(dialog.comboBox.count()):
-						if int(dialog.comboBox.itemText(i)) > int(x):
-							index = i
-							break
-
-				dialog.comboBox.setCurrentIndex(index)
-
-				if (not dialog.exec()):
-					return
-
-				depth, checked = dialog.getValues()
+				# the colors are counted in the background, the v3 parameters are asked for once they are
+				return self.run_task("Counting colors...", lambda progress: self.getColors(img), "Encoder error",
+					lambda colors: self.save_v3(file_path, img, colors, saved))
 
 			"""Save view section"""
 			# image = self.graphics_view.grab().toImage()
@@ -238,21 +258,41 @@ class MainWindow(QMainWindow):
 			# image.save(file_path + ".png")
 			# img =  Decoder().load_from(file_path + ".png")
 
-			Encoder(self.img, version, depth=depth, rle=checked, colors=colors).save_to(file_path)
-			self.message("Success", "✔️ Image saved successfully!", "#00ED64", 3000)
+			self.run_task("Saving image...", lambda progress: Encoder(img, version, progress=progress).save_to(file_path), "Encoder error", saved)
 		except Exception as e:
 			self.error_message(f"Encoder error: {str(e)}")
-	
-	def getColors(self) -> set:
-		''' Return a set of colors from the image'''
-		colors = set()
 
-		for y in range(self.img.height):
-			for x in range(self.img.width):
-				pixel = self.img[x, y]
-				colors.add(pixel)
+	def save_v3(self, file_path: str, img: Image, colors: set, saved) -> None:
+		''' Ask for the v3 parameters of an image with `colors`, then save it '''
+		try:
+			dialog = CustomDialog(self)
+			dialog.setTitles("v3 parameters")
+			dialog.setText("Enter the depth:", " RLE compression")
+			# smallest depth holding every color, a smaller one quantizes the image
+			x = next((d for d in (1, 2, 4, 8) if len(colors) <= 1 << d), 24)
+			dialog.comboBox.setCurrentIndex(dialog.comboBox.findText(str(x), Qt.MatchExactly))
+
+			if (not dialog.exec()):
+				return
+
+			depth, checked = dialog.getValues()
+			dither = None
+			if (depth <= 8 and len(colors) > 1 << depth):
+				dither, ok = QInputDialog.getItem(self, "Quantization", f"Reduce to {1 << depth} colors with dithering:", ["none", "ordered", "floyd-steinberg"], 1, False)
+				if (not ok):
+					return
+				dither = None if (dither == "none") else dither
+				colors = None
+
+			self.run_task("Saving image...",
+				lambda progress: Encoder(img, 3, depth=depth, rle=checked, colors=colors, quantize=True, dither=dither, progress=progress).save_to(file_path),
+				"Encoder error", saved)
+		except Exception as e:
+			self.error_message(f"Encoder error: {str(e)}")
 
-		return colors
+	def getColors(self, img: Image) -> set:
+		''' Return a set of colors from the image, more than 256 of them when it has more (worker thread) '''
+		return set(img.stats.palette(256))
 
 def load_stylesheet(file: str) -> str:
 	''' Load a stylesheet from a file '''